@@ -0,0 +1,68 @@
+import hmac
+import os
+from datetime import datetime, timezone
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from audit_log import query_events
+from database import get_session
+
+router = APIRouter(prefix="/admin")
+
+
+def require_admin_token(request: Request):
+    token = os.getenv("ADMIN_API_TOKEN")
+    if not token:
+        # The admin API is off unless a token is configured.
+        raise HTTPException(404)
+    scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(
+        credentials.encode(), token.encode()
+    ):
+        raise HTTPException(401, headers={"WWW-Authenticate": "Bearer"})
+
+
+def _utc(value: datetime):
+    # Times without an offset are taken as UTC.
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _parse_cursor(cursor: str):
+    try:
+        created_at, _, event_id = cursor.rpartition("_")
+        return _utc(datetime.fromisoformat(created_at)), int(event_id)
+    except ValueError:
+        raise HTTPException(400)
+
+
+@router.get(
+    "/guilds/{guild_id}/verification-events",
+    dependencies=[Depends(require_admin_token)],
+)
+async def get_verification_events(
+    guild_id: int,
+    since: datetime = None,
+    until: datetime = None,
+    cursor: str = None,
+    limit: int = Query(100, ge=1, le=1000),
+    session: AsyncSession = Depends(get_session),
+):
+    events = await query_events(
+        session,
+        guild_id,
+        since=_utc(since),
+        until=_utc(until),
+        cursor=_parse_cursor(cursor) if cursor else None,
+        limit=limit,
+    )
+    next_cursor = None
+    if len(events) == limit:
+        last = events[-1]
+        next_cursor = f"{last.created_at.isoformat()}_{last.id}"
+    return {
+        "events": [event.to_dict() for event in events],
+        "next_cursor": next_cursor,
+    }
@@ -1,29 +1,100 @@
+import asyncio
+import json
 import os
-from fastapi import APIRouter, Depends
-from fastapi.responses import FileResponse, RedirectResponse
+import time
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import RedirectResponse, StreamingResponse
 from urllib import parse
-import requests
-from sqlmodel import Session
-from database import get_session
+from audit_log import audit_log, hash_email_domain
+from database import session_scope
+from domain_rules import compile_domain_rules
+from google_id_token import GoogleKeySet, verify_id_token
+from http_client import http_client
+from metrics import failure, stage, timed
+from rate_limit import (
+    callback_admission,
+    guild_limiter,
+    ip_limiter,
+    retry_after_header,
+    user_limiter,
+)
 
-from shared import bot, processing_states
+from role_grants import RoleGrantJob
+from shared import processing_states, role_grants
 import settings_utils
+from single_flight import SingleFlight
+from state_token import state_tokens
+from static_pages import static_pages
 
 
 router = APIRouter()
 
 redirect_host = os.getenv("HOST")
 discord_redirect_uri = redirect_host + "/discord/callback"
-discord_api_endpoint = "https://discord.com/api/v10"
+discord_api_endpoint = os.getenv("DISCORD_API_ENDPOINT", "https://discord.com/api/v10")
 google_redirect_uri = redirect_host + "/google/callback"
 google_api_endpoint = "https://www.googleapis.com/oauth2/v4"
+google_token_endpoint = os.getenv(
+    "GOOGLE_TOKEN_ENDPOINT", "https://oauth2.googleapis.com/token"
+)
+google_userinfo_endpoint = os.getenv(
+    "GOOGLE_USERINFO_ENDPOINT", "https://www.googleapis.com/oauth2/v2/userinfo"
+)
+validate_flights = SingleFlight(
+    retention=float(os.getenv("VALIDATE_RESULT_RETENTION", "30"))
+)
+google_key_set = GoogleKeySet(
+    http_client,
+    os.getenv("GOOGLE_CERTS_ENDPOINT", "https://www.googleapis.com/oauth2/v3/certs"),
+)
 
 
-@router.get("/discord/auth")
+async def rate_limited(request: Request):
+    """Token buckets per client IP and, for valid states, per Discord user and guild."""
+    # async so it runs on the event loop: the buckets aren't safe to share with
+    # the threads FastAPI would run a plain def dependency in.
+    retry_after = ip_limiter.acquire(request.client.host if request.client else None)
+    state = (
+        request.query_params.get("state")
+        or request.path_params.get("state")
+        or request.path_params.get("session_id")
+    )
+    identity = state_tokens.verify(state) if state and not retry_after else None
+    if identity is not None:
+        guild_id, user_id, _ = identity
+        retry_after = user_limiter.acquire(user_id) or guild_limiter.acquire(guild_id)
+    if retry_after:
+        failure("rate_limit", "too_many_requests")
+        raise HTTPException(429, headers=retry_after_header(retry_after))
+
+
+async def admitted():
+    """Caps the callbacks and /validate running at once; overload is turned away early."""
+    if not callback_admission.try_acquire():
+        failure("rate_limit", "overloaded")
+        raise HTTPException(503, headers=retry_after_header(1))
+    try:
+        yield
+    finally:
+        callback_admission.release()
+
+
+def elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+async def get_verification_state(state: str):
+    # Forged or expired states are rejected before they reach the store.
+    if state_tokens.verify(state) is None:
+        return None
+    return await processing_states.get(state)
+
+
+@router.get("/discord/auth", dependencies=[Depends(rate_limited)])
 async def discord_oauth2(state: str):
     DISCORD_AUTHORIZATION_URL = "https://discord.com/oauth2/authorize/?"
 
-    if state not in processing_states:
+    if await get_verification_state(state) is None:
         return "There's no data for this state. Please try again!"
 
     parameters = {
@@ -38,8 +109,17 @@ async def discord_oauth2(state: str):
     return RedirectResponse(DISCORD_AUTHORIZATION_URL + parse.urlencode(parameters))
 
 
-@router.get("/discord/callback")
+@router.get(
+    "/discord/callback", dependencies=[Depends(rate_limited), Depends(admitted)]
+)
+@timed("discord_callback")
 async def discord_callback(code: str, state: str):
+    started = time.perf_counter()
+    identity = state_tokens.verify(state)
+    verification_state = await processing_states.get(state) if identity else None
+    if verification_state is None:
+        failure("discord_callback", "state_not_found")
+        return "There's no data for this state. Please try again!"
     discord_user_data = {
         "client_id": os.getenv("DISCORD_CLIENT_ID"),
         "client_secret": os.getenv("DISCORD_CLIENT_SECRET"),
@@ -47,33 +127,48 @@ async def discord_callback(code: str, state: str):
         "code": code,
         "redirect_uri": discord_redirect_uri,
     }
-    discord_token = requests.post(
-        discord_api_endpoint + "/oauth2/token", data=discord_user_data
-    )
-    discord_token.raise_for_status()
-    discord_user = requests.get(
-        discord_api_endpoint + "/users/@me",
-        headers={"Authorization": f"Bearer {discord_token.json()['access_token']}"},
+    with stage("discord_token_exchange"):
+        discord_token = await http_client.post_form(
+            discord_api_endpoint + "/oauth2/token", data=discord_user_data
+        )
+    with stage("discord_userinfo"):
+        discord_user_data = await http_client.get_json(
+            discord_api_endpoint + "/users/@me",
+            headers={"Authorization": f"Bearer {discord_token['access_token']}"},
+        )
+    # The token may expire during the exchange; use the identity checked on arrival.
+    guild_id, user_id, _ = identity
+    if discord_user_data["id"] != str(user_id):
+        failure("discord_callback", "user_mismatch")
+        audit_log.record(
+            guild_id,
+            user_id,
+            "user_mismatch",
+            timings={**verification_state.timings, "discord_callback": elapsed_ms(started)},
+        )
+        return "This Discord account did not start this verification."
+    await processing_states.update(
+        state,
+        discord={
+            "id": discord_user_data["id"],
+            "username": discord_user_data["username"],
+            "global_name": discord_user_data["global_name"],
+        },
+        timings={**verification_state.timings, "discord_callback": elapsed_ms(started)},
     )
-    discord_user_data = discord_user.json()
-    processing_states[state]["discord"] = {
-        "id": discord_user_data["id"],
-        "username": discord_user_data["username"],
-        "global_name": discord_user_data["global_name"],
-    }
     return RedirectResponse("/" + state)
 
 
-@router.get("/google/auth")
+@router.get("/google/auth", dependencies=[Depends(rate_limited)])
 async def google_oauth2(state: str):
     GOOGLE_AUTHORIZATION_URL = "https://accounts.google.com/o/oauth2/v2/auth?"
 
-    if state not in processing_states:
+    if await get_verification_state(state) is None:
         return "There's no data for this state. Please try again!"
     parameters = {
         "response_type": "code",
         "client_id": os.getenv("GOOGLE_CLIENT_ID"),
-        "scope": "email",
+        "scope": "openid email",
         "redirect_uri": google_redirect_uri,
         "state": state,
     }
@@ -81,8 +176,16 @@ async def google_oauth2(state: str):
     return RedirectResponse(GOOGLE_AUTHORIZATION_URL + parse.urlencode(parameters))
 
 
-@router.get("/google/callback")
+@router.get(
+    "/google/callback", dependencies=[Depends(rate_limited), Depends(admitted)]
+)
+@timed("google_callback")
 async def google_callback(code: str, state: str):
+    started = time.perf_counter()
+    verification_state = await get_verification_state(state)
+    if verification_state is None:
+        failure("google_callback", "state_not_found")
+        return "There's no data for this state. Please try again!"
     google_user_data = {
         "client_id": os.getenv("GOOGLE_CLIENT_ID"),
         "client_secret": os.getenv("GOOGLE_CLIENT_SECRET"),
@@ -90,57 +193,157 @@ async def google_callback(code: str, state: str):
         "code": code,
         "redirect_uri": google_redirect_uri,
     }
-    google_token = requests.post(
-        "https://oauth2.googleapis.com/token", data=google_user_data
-    )
-    google_token.raise_for_status()
-    google_user = requests.get(
-        "https://www.googleapis.com/oauth2/v2/userinfo?access_token="
-        + google_token.json()["access_token"]
+    with stage("google_token_exchange"):
+        google_token = await http_client.post_form(
+            google_token_endpoint, data=google_user_data
+        )
+    if "id_token" in google_token:
+        # The ID token already carries email and hd, no need to ask userinfo.
+        with stage("google_id_token"):
+            google_user_data = await verify_id_token(
+                google_key_set, google_token["id_token"], os.getenv("GOOGLE_CLIENT_ID")
+            )
+    else:
+        with stage("google_userinfo"):
+            google_user_data = await http_client.get_json(
+                google_userinfo_endpoint,
+                params={"access_token": google_token["access_token"]},
+            )
+    await processing_states.update(
+        state,
+        google={
+            "email": google_user_data["email"],
+            "organization": google_user_data.get("hd"),
+            "allowed": compile_domain_rules(tuple(verification_state.domain)).matches(
+                google_user_data.get("hd")
+            ),
+        },
+        timings={**verification_state.timings, "google_callback": elapsed_ms(started)},
     )
-    google_user_data = google_user.json()
-    processing_states[state]["google"] = {
-        "email": google_user_data["email"],
-        "organization": google_user_data.get("hd"),
-    }
     return RedirectResponse("/" + state)
 
 
-@router.get("/session/{session_id}")
+@router.get("/session/{session_id}", dependencies=[Depends(rate_limited)])
 async def get_session_id(session_id: str):
-    if session_id not in processing_states:
+    verification_state = await get_verification_state(session_id)
+    if verification_state is None:
         return "There's no data for this state. Please try again!"
-    return processing_states[session_id]
+    return verification_state.to_dict()
 
 
-@router.get("/validate")
-async def validate(state: str, session: Session = Depends(get_session)):
-    if state not in processing_states:
+@router.get("/session/{session_id}/events", dependencies=[Depends(rate_limited)])
+async def get_session_events(session_id: str, request: Request):
+    verification_state = await get_verification_state(session_id)
+    if verification_state is None:
         return "There's no data for this state. Please try again!"
 
-    settings = settings_utils.get_settings(
-        session, processing_states[state]["guild_id"]
+    async def stream():
+        changed = processing_states.subscribe(session_id)
+        record = verification_state
+        last_sent = None
+        try:
+            while record is not None:
+                data = record.to_dict()
+                if data != last_sent:
+                    yield f"event: state\ndata: {json.dumps(data)}\n\n"
+                    last_sent = data
+                if data["status"] in ("granted", "failed"):
+                    # Tells the page to close the EventSource instead of reconnecting.
+                    yield "event: done\ndata: {}\n\n"
+                    return
+                try:
+                    await asyncio.wait_for(
+                        changed.wait(), processing_states.event_poll_interval
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                changed.clear()
+                if await request.is_disconnected():
+                    return
+                # Watching the page isn't activity; don't keep the state alive.
+                record = await processing_states.peek(session_id)
+            yield "event: expired\ndata: {}\n\n"
+        finally:
+            processing_states.unsubscribe(session_id, changed)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    if processing_states[state]["google"] and processing_states[state]["discord"]:
-        if not settings.is_allowed(
-            processing_states[state]["google"]["organization"],
-        ):
+
+
+@router.get("/validate", dependencies=[Depends(rate_limited), Depends(admitted)])
+async def validate(state: str):
+    # Double clicks and browser retries join the running validation, and repeats
+    # shortly after a success get the same redirect without touching Discord.
+    return await validate_flights.run(
+        state,
+        lambda: validate_state(state),
+        keep=lambda response: isinstance(response, RedirectResponse),
+    )
+
+
+@timed("validate")
+async def validate_state(state: str):
+    started = time.perf_counter()
+    verification_state = await get_verification_state(state)
+    if verification_state is None:
+        failure("validate", "state_not_found")
+        return "There's no data for this state. Please try again!"
+
+    if verification_state.status is not None:
+        return RedirectResponse("/success#" + state)
+
+    async with session_scope() as session:
+        settings = await settings_utils.get_settings(
+            session, verification_state.guild_id
+        )
+    if verification_state.google and verification_state.discord:
+        organization = verification_state.google["organization"]
+        # The hd claim is missing for consumer accounts, so hash the address's domain.
+        email_domain_hash = hash_email_domain(
+            verification_state.google["email"].rpartition("@")[2]
+        )
+        if not settings.is_allowed(organization):
+            failure("validate", "domain_not_allowed")
+            audit_log.record(
+                verification_state.guild_id,
+                verification_state.discord["id"],
+                "domain_not_allowed",
+                email_domain_hash,
+                {**verification_state.timings, "validate": elapsed_ms(started)},
+            )
             return "This domain is not allowed."
-        channel = bot.get_channel(int(settings.verification_log_channel_id))
-        user = bot.get_user(int(processing_states[state]["discord"]["id"]))
-        role = channel.guild.get_role(int(settings.verified_role_id))
-        await channel.guild.get_member(user.id).add_roles(
-            role, reason="Verification completed."
+        role_grants.enqueue(
+            RoleGrantJob(
+                guild_id=int(verification_state.guild_id),
+                user_id=int(verification_state.discord["id"]),
+                role_id=int(settings.verified_role_id),
+                log_channel_id=int(settings.verification_log_channel_id),
+                state=state,
+                audit={
+                    "email_domain_hash": email_domain_hash,
+                    "timings": {
+                        **verification_state.timings,
+                        "validate": elapsed_ms(started),
+                    },
+                },
+            )
+        )
+        # The linked accounts are no longer needed once the grant is queued.
+        await processing_states.update(
+            state, status="verified", discord=None, google=None
         )
-        await channel.send(f"{user.mention}さんの認証が完了しました！")
-        del processing_states[state]
-        return RedirectResponse("/success")
+        return RedirectResponse("/success#" + state)
 
+    failure("validate", "incomplete")
     return "Validation failed."
 
 
-@router.get("/{state}")
-async def auth_page(state: str):
+@router.get("/{state}", dependencies=[Depends(rate_limited)])
+async def auth_page(state: str, request: Request):
+    # main.html reads the state from the URL itself, so one cached copy serves every state.
     if state == "success":
-        return FileResponse("success.html")
-    return FileResponse("main.html")
+        return static_pages.response(request, "success")
+    return static_pages.response(request, "main")
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import secrets
+from collections import deque
+from datetime import datetime
+from logging import getLogger
+
+from dotenv import load_dotenv
+from sqlalchemy import insert, or_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from database import session_scope
+from models import VerificationEvent
+
+load_dotenv()
+logger = getLogger("discord")
+
+
+def _load_salt() -> bytes:
+    salt = os.getenv("AUDIT_LOG_SALT")
+    if salt:
+        return salt.encode()
+    # Every process writes to the same table; their hashes must agree.
+    if (
+        os.getenv("RUN_MODE", "all") != "all"
+        or os.getenv("STATE_BACKEND", "memory") != "memory"
+    ):
+        raise RuntimeError(
+            "AUDIT_LOG_SALT must be set when the bot and web server run as separate "
+            "processes or the state store is shared."
+        )
+    logger.warning(
+        "AUDIT_LOG_SALT is not set. Using a random salt, so email domain hashes "
+        "recorded before and after a restart can't be compared."
+    )
+    return secrets.token_bytes(32)
+
+
+_salt = _load_salt()
+
+
+def hash_email_domain(domain: str) -> str:
+    """Keyed hash of a domain, comparable between events but not reversible without the salt."""
+    if not domain:
+        return None
+    return hmac.new(_salt, domain.lower().encode(), hashlib.sha256).hexdigest()
+
+
+class AuditLog:
+    """Write-behind buffer for the verification_event table.
+
+    `record` only appends to memory; the buffer is written in one INSERT every
+    `interval` seconds, or as soon as `batch_size` events are waiting. When the
+    database can't keep up, the oldest events beyond `max_buffer` are dropped.
+    """
+
+    def __init__(self, interval: float = 5, batch_size: int = 500, max_buffer: int = 50000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._buffer: deque[dict] = deque(maxlen=max_buffer)
+        self._lock = asyncio.Lock()
+        self._flusher: asyncio.Task = None
+        self._flushes: set[asyncio.Task] = set()
+        self.written = 0
+
+    def record(
+        self,
+        guild_id: int,
+        user_id: int,
+        outcome: str,
+        email_domain_hash: str = None,
+        timings: dict = None,
+    ):
+        self._buffer.append(
+            VerificationEvent(
+                guild_id=str(guild_id),
+                user_id=str(user_id),
+                email_domain_hash=email_domain_hash,
+                outcome=outcome,
+                timings=timings or {},
+            ).model_dump(exclude={"id"})
+        )
+        if len(self._buffer) >= self.batch_size and self._flusher is not None:
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    def start(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self.flush()
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            while self._buffer:
+                rows = [
+                    self._buffer.popleft()
+                    for _ in range(min(self.batch_size, len(self._buffer)))
+                ]
+                try:
+                    async with session_scope() as session:
+                        await session.exec(insert(VerificationEvent), params=rows)
+                        await session.commit()
+                except Exception as e:
+                    logger.warning(f"Failed to write {len(rows)} verification events: {e}")
+                    self._buffer.extendleft(reversed(rows))
+                    return
+                self.written += len(rows)
+
+    def stats(self):
+        return {"buffered": len(self._buffer), "written": self.written}
+
+
+async def query_events(
+    session: AsyncSession,
+    guild_id: int,
+    since: datetime = None,
+    until: datetime = None,
+    cursor: tuple[datetime, int] = None,
+    limit: int = 100,
+) -> list[VerificationEvent]:
+    """Newest events first. Pass the last event's (created_at, id) as `cursor` for the next page."""
+    statement = select(VerificationEvent).where(
+        VerificationEvent.guild_id == str(guild_id)
+    )
+    if since is not None:
+        statement = statement.where(VerificationEvent.created_at >= since)
+    if until is not None:
+        statement = statement.where(VerificationEvent.created_at < until)
+    if cursor is not None:
+        created_at, event_id = cursor
+        statement = statement.where(
+            or_(
+                VerificationEvent.created_at < created_at,
+                (VerificationEvent.created_at == created_at)
+                & (VerificationEvent.id < event_id),
+            )
+        )
+    statement = statement.order_by(
+        VerificationEvent.created_at.desc(), VerificationEvent.id.desc()
+    ).limit(limit)
+    result = await session.exec(statement)
+    return result.all()
+
+
+audit_log = AuditLog(
+    interval=float(os.getenv("AUDIT_LOG_FLUSH_INTERVAL", "5")),
+    batch_size=int(os.getenv("AUDIT_LOG_BATCH_SIZE", "500")),
+)
@@ -0,0 +1,125 @@
+"""Check that verify_id_token() rejects every kind of bad Google ID token.
+
+    python -m bench.check_id_tokens
+
+The signing keys are served by bench/fake_upstreams.py, so nothing leaves the host.
+"""
+import argparse
+import asyncio
+import time
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from bench.fake_upstreams import FakeUpstreams
+from google_id_token import GoogleKeySet, verify_id_token
+from http_client import HTTPClient
+
+AUDIENCE = "bench"
+
+
+def sign(upstreams: FakeUpstreams, key=None, kid=None, algorithm="RS256", **claims):
+    now = int(time.time())
+    payload = {
+        "iss": "https://accounts.google.com",
+        "aud": AUDIENCE,
+        "sub": "1",
+        "iat": now,
+        "exp": now + 3600,
+        "email": "user@example.com",
+        "email_verified": True,
+    }
+    payload.update(claims)
+    return jwt.encode(
+        payload,
+        key or upstreams.private_key,
+        algorithm=algorithm,
+        headers={"kid": kid or upstreams.kid},
+    )
+
+
+async def rejected(key_set: GoogleKeySet, token: str, error: type):
+    try:
+        await verify_id_token(key_set, token, AUDIENCE)
+    except error:
+        return
+    raise AssertionError(f"Expected {error.__name__}")
+
+
+async def check(upstreams: FakeUpstreams, key_set: GoogleKeySet):
+    claims = await verify_id_token(key_set, sign(upstreams), AUDIENCE)
+    assert claims["email"] == "user@example.com"
+    fetches = upstreams.requests
+    assert fetches == 1, fetches
+
+    now = int(time.time())
+    await rejected(
+        key_set, sign(upstreams, aud="someone-else"), jwt.InvalidAudienceError
+    )
+    # Older than the 30 second leeway.
+    expired = sign(upstreams, iat=now - 3700, exp=now - 60)
+    await rejected(key_set, expired, jwt.ExpiredSignatureError)
+    await rejected(
+        key_set, sign(upstreams, iss="https://evil.example"), jwt.InvalidIssuerError
+    )
+    unverified = sign(upstreams, email_verified=False)
+    await rejected(key_set, unverified, jwt.InvalidTokenError)
+    # Google's kid, but signed with somebody else's key.
+    foreign_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    await rejected(key_set, sign(upstreams, key=foreign_key), jwt.InvalidSignatureError)
+    # A symmetric token must not be accepted whatever its secret is.
+    await rejected(
+        key_set,
+        sign(upstreams, key="secret" * 6, algorithm="HS256"),
+        jwt.InvalidAlgorithmError,
+    )
+    await rejected(key_set, sign(upstreams, kid="unknown"), jwt.InvalidKeyError)
+    # The set was fetched a moment ago, so none of that refetched it.
+    assert upstreams.requests == fetches, upstreams.requests
+
+    # Google rotates its keys. Within min_refresh_interval of the last fetch,
+    # the new kid is rejected without asking Google again...
+    upstreams.private_key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048
+    )
+    upstreams.kid = "rotated"
+    await rejected(key_set, sign(upstreams), jwt.InvalidKeyError)
+    assert upstreams.requests == fetches, upstreams.requests
+
+    # ...and once it has passed, a burst of tokens with unknown kids refetches once.
+    await asyncio.sleep(key_set.min_refresh_interval)
+    unknown = [sign(upstreams, kid=f"bogus{i}") for i in range(10)]
+    results = await asyncio.gather(
+        *(verify_id_token(key_set, sign(upstreams), AUDIENCE) for _ in range(10)),
+        *(rejected(key_set, token, jwt.InvalidKeyError) for token in unknown),
+    )
+    assert all(claims["sub"] == "1" for claims in results[:10])
+    assert upstreams.requests == fetches + 1, upstreams.requests
+
+
+async def run():
+    upstreams = FakeUpstreams()
+    await upstreams.start()
+    http_client = HTTPClient()
+    await http_client.open()
+    key_set = GoogleKeySet(
+        http_client,
+        upstreams.base_url + "/google/oauth2/v3/certs",
+        min_refresh_interval=0.5,
+    )
+    try:
+        await check(upstreams, key_set)
+        print("verify_id_token: ok")
+    finally:
+        await http_client.close()
+        await upstreams.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.parse_args()
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
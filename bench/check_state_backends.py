@@ -0,0 +1,88 @@
+"""Run the same checks against every verification state backend.
+
+    python -m bench.check_state_backends [--redis-url redis://localhost:6379/15]
+
+Without --redis-url, the Redis backend runs against bench/fake_redis.py.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+
+from bench.fake_redis import FakeRedis
+from state_backends import RedisStateStore, SQLiteStateStore
+from state_store import StateBackend, StateStore, VerificationState
+
+
+async def check(store: StateBackend):
+    await store.create("s1", VerificationState("Guild", ["example.com"], 1, 10))
+    record = await store.get("s1")
+    assert record.guild_name == "Guild" and record.user_id == 10
+
+    # The two callbacks race on the same state; neither may drop the other's field.
+    await asyncio.gather(
+        store.update("s1", discord={"id": "10"}),
+        store.update("s1", google={"email": "user@example.com"}),
+    )
+    record = await store.get("s1")
+    assert record.discord == {"id": "10"}, record.discord
+    assert record.google == {"email": "user@example.com"}, record.google
+
+    state, record = await store.find(1, 10)
+    assert state == "s1"
+    record = await store.update("s1", status="verified", discord=None)
+    assert record.status == "verified" and record.discord is None
+    assert await store.get("missing") is None
+    assert await store.update("missing", status="failed") is None
+
+    # Expired states disappear, and updating one must not bring it back.
+    store.ttl = 0.2
+    await store.create("s2", VerificationState("Guild", [], 1, 11))
+    await asyncio.sleep(0.3)
+    assert await store.get("s2") is None
+    assert await store.update("s2", google={"email": "late@example.com"}) is None
+    assert await store.get("s2") is None
+    assert await store.find(1, 11) is None
+
+    # peek() reads without extending the TTL, so polling alone lets a state expire.
+    await store.create("s3", VerificationState("Guild", [], 1, 12))
+    await asyncio.sleep(0.12)
+    assert (await store.peek("s3")).user_id == 12
+    await asyncio.sleep(0.12)
+    assert await store.peek("s3") is None
+
+    await store.delete("s1")
+    assert await store.get("s1") is None
+
+
+async def run(redis_url: str):
+    stores = [StateStore()]
+    directory = tempfile.mkdtemp()
+    stores.append(SQLiteStateStore(os.path.join(directory, "states.db")))
+    fake_redis = None
+    if redis_url is None:
+        fake_redis = FakeRedis()
+        await fake_redis.start()
+        redis_url = fake_redis.url
+    stores.append(RedisStateStore(redis_url, prefix="enforcer-check:"))
+
+    try:
+        for store in stores:
+            await check(store)
+            print(f"{type(store).__name__}: ok")
+    finally:
+        for store in stores:
+            await store.close()
+        if fake_redis is not None:
+            await fake_redis.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis-url", help="Check against a real Redis server.")
+    args = parser.parse_args()
+    asyncio.run(run(args.redis_url))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+class FakePermissions:
+    manage_roles = True
+    send_messages = True
+
+
+class FakeRole:
+    def __init__(self, role_id: int, position: int = 1):
+        self.id = role_id
+        self.position = position
+        self.managed = False
+
+
+class FakeMember:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.roles = []
+        self.mention = f"<@{user_id}>"
+
+    async def add_roles(self, *roles, reason=None):
+        self.roles.extend(roles)
+
+
+class FakeBotMember:
+    """The bot's own member, as checked by GuildSettings.validate_settings()."""
+
+    def __init__(self):
+        self.guild_permissions = FakePermissions()
+        self.top_role = FakeRole(0, position=100)
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, guild: "FakeGuild"):
+        self.id = channel_id
+        self.guild = guild
+        self.messages = []
+
+    def permissions_for(self, member):
+        return FakePermissions()
+
+    async def send(self, content=None, **kwargs):
+        self.messages.append(content)
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, role: FakeRole):
+        self.id = guild_id
+        self.name = "Bench Guild"
+        self.role = role
+        self.members: dict[int, FakeMember] = {}
+        self.me = FakeBotMember()
+        self.owner = None
+
+    def get_role(self, role_id: int):
+        return self.role if role_id == self.role.id else None
+
+    def get_member(self, user_id: int):
+        return self.members.setdefault(user_id, FakeMember(user_id))
+
+    async def fetch_member(self, user_id: int):
+        return self.get_member(user_id)
+
+
+class FakeBot:
+    """Just enough of discord.Client for settings validation and the role grant workers."""
+
+    def __init__(self, guild: FakeGuild, channel: FakeChannel):
+        self.guild = guild
+        self.channel = channel
+        self.latency = 0.0
+
+    def get_guild(self, guild_id: int):
+        return self.guild if guild_id == self.guild.id else None
+
+    def get_channel(self, channel_id: int):
+        return self.channel if channel_id == self.channel.id else None
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.global_name = "Bench User"
+
+
+class FakeResponse:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, content=None, **kwargs):
+        self.messages.append(content)
+
+
+class FakeInteraction:
+    """A button press or /verify, as shared.start_verification sees it."""
+
+    def __init__(self, client: FakeBot, user: FakeUser):
+        self.client = client
+        self.guild = client.guild
+        self.user = user
+        self.response = FakeResponse()
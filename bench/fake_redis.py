@@ -0,0 +1,143 @@
+import asyncio
+import time
+
+
+class FakeRedis:
+    """Local stand-in for a Redis server, speaking just enough RESP for RedisStateStore.
+
+    Supports HELLO (RESP2 and RESP3), PING, SELECT, CLIENT, GET, SET (with PX),
+    DEL, HSET, HGETALL, PEXPIRE and MULTI/EXEC. Expiry is checked lazily on
+    access, like Redis does.
+    """
+
+    def __init__(self):
+        self._data: dict[str, object] = {}
+        self._expires: dict[str, float] = {}
+        self._server: asyncio.Server = None
+        self.commands = 0
+        self.url: str = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"redis://{host}:{port}/0"
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _read_command(self, reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.decode().split()
+        arguments = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            arguments.append((await reader.readexactly(length + 2))[:-2].decode())
+        return arguments
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        queued = None
+        protocol = 2
+        try:
+            while (command := await self._read_command(reader)) is not None:
+                self.commands += 1
+                name = command[0].upper()
+                if name == "HELLO":
+                    protocol = int(command[1]) if len(command) > 1 else protocol
+                    reply = {"server": "fake", "version": "7.0.0", "proto": protocol}
+                elif name == "MULTI":
+                    queued = []
+                    reply = "OK"
+                elif name == "EXEC":
+                    reply = [self._execute(*command) for command in queued]
+                    queued = None
+                elif name == "DISCARD":
+                    queued = None
+                    reply = "OK"
+                elif queued is not None:
+                    queued.append(command)
+                    reply = "QUEUED"
+                else:
+                    reply = self._execute(*command)
+                writer.write(self._encode(reply, protocol))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _encode(self, value, protocol: int = 2) -> bytes:
+        if value is None:
+            return b"_\r\n" if protocol == 3 else b"$-1\r\n"
+        if isinstance(value, Exception):
+            return f"-ERR {value}\r\n".encode()
+        if isinstance(value, bool):
+            return f":{int(value)}\r\n".encode()
+        if isinstance(value, int):
+            return f":{value}\r\n".encode()
+        if value in ("OK", "QUEUED", "PONG"):
+            return f"+{value}\r\n".encode()
+        if isinstance(value, dict):
+            items = [item for pair in value.items() for item in pair]
+            if protocol == 2:
+                return self._encode(items)
+            return f"%{len(value)}\r\n".encode() + b"".join(
+                self._encode(item, protocol) for item in items
+            )
+        if isinstance(value, list):
+            return f"*{len(value)}\r\n".encode() + b"".join(
+                self._encode(item, protocol) for item in value
+            )
+        data = value.encode()
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    def _live(self, key: str):
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            del self._expires[key]
+        return self._data.get(key)
+
+    def _execute(self, name: str, *arguments: str):
+        name = name.upper()
+        if name == "PING":
+            return "PONG"
+        if name in ("SELECT", "CLIENT"):
+            return "OK"
+        if name == "GET":
+            return self._live(arguments[0])
+        if name == "SET":
+            key, value, *options = arguments
+            self._data[key] = value
+            self._expires.pop(key, None)
+            if len(options) == 2 and options[0].upper() == "PX":
+                self._expires[key] = time.monotonic() + int(options[1]) / 1000
+            return "OK"
+        if name == "DEL":
+            removed = 0
+            for key in arguments:
+                removed += self._live(key) is not None
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+            return removed
+        if name == "HSET":
+            key, *pairs = arguments
+            fields = self._live(key)
+            if fields is None:
+                fields = self._data[key] = {}
+            added = sum(field not in fields for field in pairs[::2])
+            fields.update(zip(pairs[::2], pairs[1::2]))
+            return added
+        if name == "HGETALL":
+            return dict(self._live(arguments[0]) or {})
+        if name == "PEXPIRE":
+            key, milliseconds = arguments
+            if self._live(key) is None:
+                return 0
+            self._expires[key] = time.monotonic() + int(milliseconds) / 1000
+            return 1
+        return ValueError(f"unknown command '{name}'")
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import time
+
+import jwt
+from aiohttp import web
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+class FakeUpstreams:
+    """Local stand-ins for Discord's and Google's OAuth endpoints.
+
+    The authorization code doubles as the access token and the user ID, and
+    every endpoint answers after `latency` seconds.
+    Google's token response also carries an ID token signed with a locally
+    generated key, published on the certs endpoint.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        domain: str = "example.com",
+        client_id: str = "bench",
+        id_tokens: bool = True,
+    ):
+        self.latency = latency
+        self.domain = domain
+        self.client_id = client_id
+        self.id_tokens = id_tokens
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.kid = "bench-key"
+        self.requests = 0
+        self._runner: web.AppRunner = None
+        self.base_url: str = None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/discord/api/v10/oauth2/token", self.token)
+        app.router.add_get("/discord/api/v10/users/@me", self.discord_user)
+        app.router.add_post("/google/token", self.google_token)
+        app.router.add_get("/google/oauth2/v2/userinfo", self.google_user)
+        app.router.add_get("/google/oauth2/v3/certs", self.google_certs)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _respond(self, data: dict):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response(data)
+
+    async def token(self, request: web.Request):
+        form = await request.post()
+        if "code" not in form:
+            raise web.HTTPBadRequest()
+        return await self._respond({"access_token": form["code"], "token_type": "Bearer"})
+
+    async def google_token(self, request: web.Request):
+        form = await request.post()
+        if "code" not in form:
+            raise web.HTTPBadRequest()
+        token = form["code"]
+        data = {"access_token": token, "token_type": "Bearer"}
+        if self.id_tokens:
+            now = int(time.time())
+            data["id_token"] = jwt.encode(
+                {
+                    "iss": "https://accounts.google.com",
+                    "aud": self.client_id,
+                    "sub": token,
+                    "iat": now,
+                    "exp": now + 3600,
+                    "email": f"user{token}@{self.domain}",
+                    "email_verified": True,
+                    "hd": self.domain,
+                },
+                self.private_key,
+                algorithm="RS256",
+                headers={"kid": self.kid},
+            )
+        return await self._respond(data)
+
+    async def google_certs(self, request: web.Request):
+        key = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.private_key.public_key()))
+        key.update({"kid": self.kid, "alg": "RS256", "use": "sig"})
+        self.requests += 1
+        return web.json_response(
+            {"keys": [key]}, headers={"Cache-Control": "public, max-age=3600"}
+        )
+
+    async def discord_user(self, request: web.Request):
+        user_id = request.headers["Authorization"].removeprefix("Bearer ")
+        return await self._respond(
+            {"id": user_id, "username": f"user{user_id}", "global_name": "Bench User"}
+        )
+
+    async def google_user(self, request: web.Request):
+        token = request.query["access_token"]
+        return await self._respond(
+            {"email": f"user{token}@{self.domain}", "hd": self.domain}
+        )
@@ -0,0 +1,236 @@
+"""End-to-end load test for api/api_v1.py against local fake upstreams.
+
+    python -m bench.load_test --flows 2000 --concurrency 200
+
+Each flow presses the verification button through shared.start_verification
+with a fake interaction, then runs /google/auth,
+/google/callback and /validate (plus the Discord OAuth leg with
+--discord-oauth), then the run waits until the role grant workers have
+drained the queue.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+
+from bench.fake_discord import (
+    FakeBot,
+    FakeChannel,
+    FakeGuild,
+    FakeInteraction,
+    FakeRole,
+    FakeUser,
+)
+from bench.fake_redis import FakeRedis
+from bench.fake_upstreams import FakeUpstreams
+
+GUILD_ID = 1000
+ROLE_ID = 2000
+CHANNEL_ID = 3000
+DOMAIN = "example.com"
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def configure_environment(
+    upstreams: FakeUpstreams, discord_oauth: bool, state_backend: str, redis_url: str
+):
+    os.environ.update(
+        {
+            "STATE_BACKEND": state_backend,
+            "STATE_SQLITE_PATH": os.path.join(tempfile.mkdtemp(), "states.db"),
+            "STATE_REDIS_URL": redis_url or "",
+            "STATE_SECRET": "bench",
+            "AUDIT_LOG_SALT": "bench",
+            "DISCORD_OAUTH_REQUIRED": "1" if discord_oauth else "0",
+            # Every flow comes from one client IP and one guild.
+            "RATE_LIMIT_IP_BURST": "1000000",
+            "RATE_LIMIT_GUILD_BURST": "1000000",
+            "HOST": "http://enforcer.test",
+            "PUBLIC_BOT_FEATURES": "0",
+            "DOMAINS": DOMAIN,
+            "VERIFIED_ROLE_ID": str(ROLE_ID),
+            "VERIFICATION_LOG_CHANNEL_ID": str(CHANNEL_ID),
+            "DISCORD_CLIENT_ID": "bench",
+            "DISCORD_CLIENT_SECRET": "bench",
+            "GOOGLE_CLIENT_ID": "bench",
+            "GOOGLE_CLIENT_SECRET": "bench",
+            "DISCORD_API_ENDPOINT": upstreams.base_url + "/discord/api/v10",
+            "GOOGLE_TOKEN_ENDPOINT": upstreams.base_url + "/google/token",
+            "GOOGLE_USERINFO_ENDPOINT": upstreams.base_url
+            + "/google/oauth2/v2/userinfo",
+            "GOOGLE_CERTS_ENDPOINT": upstreams.base_url + "/google/oauth2/v3/certs",
+        }
+    )
+
+
+async def run(
+    flows: int,
+    concurrency: int,
+    upstream_latency: float,
+    id_tokens: bool,
+    discord_oauth: bool,
+    state_backend: str,
+):
+    upstreams = FakeUpstreams(
+        latency=upstream_latency, domain=DOMAIN, id_tokens=id_tokens
+    )
+    await upstreams.start()
+    fake_redis = None
+    if state_backend == "redis":
+        fake_redis = FakeRedis()
+        await fake_redis.start()
+    configure_environment(
+        upstreams, discord_oauth, state_backend, fake_redis and fake_redis.url
+    )
+
+    # Imported late so the module-level configuration picks up the fakes.
+    import httpx
+    from fastapi import FastAPI
+
+    from api.api_v1 import router
+    from http_client import http_client
+    import shared
+
+    guild = FakeGuild(GUILD_ID, FakeRole(ROLE_ID))
+    channel = FakeChannel(CHANNEL_ID, guild)
+    fake_bot = FakeBot(guild, channel)
+    shared.role_grants.bot = fake_bot
+    shared.verification_log.bot = fake_bot
+
+    app = FastAPI()
+    app.include_router(router)
+    await http_client.open()
+    shared.role_grants.start()
+    shared.verification_log.start()
+
+    latencies: defaultdict[str, list[float]] = defaultdict(list)
+    errors: defaultdict[str, int] = defaultdict(int)
+    semaphore = asyncio.Semaphore(concurrency)
+    user_ids = itertools.count(100000000000000000)
+
+    async def step(client: httpx.AsyncClient, name: str, url: str, expected: str):
+        started = time.perf_counter()
+        response = await client.get(url)
+        latencies[name].append(time.perf_counter() - started)
+        location = response.headers.get("location", "")
+        if response.status_code >= 400 or expected not in location:
+            errors[name] += 1
+            return False
+        return True
+
+    async def flow(client: httpx.AsyncClient):
+        async with semaphore:
+            user_id = next(user_ids)
+            interaction = FakeInteraction(fake_bot, FakeUser(user_id))
+            started = time.perf_counter()
+            await shared.start_verification(interaction)
+            latencies["start_verification"].append(time.perf_counter() - started)
+            # The URL is the last line of the ephemeral reply.
+            url = interaction.response.messages[-1].splitlines()[-1]
+            if not url.startswith(os.environ["HOST"] + "/"):
+                errors["start_verification"] += 1
+                return
+            state = url.rpartition("/")[2]
+            code = f"code={user_id}&state={state}"
+            steps = (
+                ("discord_auth", f"/discord/auth?state={state}", "discord.com"),
+                ("discord_callback", f"/discord/callback?{code}", state),
+                ("google_auth", f"/google/auth?state={state}", "google.com"),
+                ("google_callback", f"/google/callback?{code}", state),
+                ("validate", f"/validate?state={state}", "/success"),
+            )[0 if discord_oauth else 2 :]
+            for name, url, expected in steps:
+                if not await step(client, name, url, expected):
+                    return
+            latencies["flow"].append(time.perf_counter() - started)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://enforcer.test"
+    ) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(flow(client) for _ in range(flows)))
+        requests_done = time.perf_counter()
+        await shared.role_grants.queue.join()
+        await shared.verification_log.flush_all()
+        finished = time.perf_counter()
+
+    await shared.role_grants.stop()
+    await shared.verification_log.stop()
+    await http_client.close()
+    await shared.processing_states.close()
+    await upstreams.stop()
+    if fake_redis is not None:
+        await fake_redis.stop()
+
+    completed = len(latencies["flow"])
+    granted = sum(1 for member in guild.members.values() if member.roles)
+    print(f"flows: {completed} / {flows} completed, {granted} roles granted")
+    print(f"upstream requests: {upstreams.requests}")
+    print(
+        f"throughput: {completed / (requests_done - started):.1f} flows/s"
+        f" (role grants drained after {finished - started:.2f}s)"
+    )
+    print(f"{'step':<18}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, values in latencies.items():
+        print(
+            f"{name:<18}{len(values):>8}"
+            f"{statistics.fmean(values) * 1000:>10.2f}"
+            f"{percentile(values, 0.5) * 1000:>10.2f}"
+            f"{percentile(values, 0.99) * 1000:>10.2f}"
+        )
+    if errors:
+        print("errors:", dict(errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--flows", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument(
+        "--upstream-latency",
+        type=float,
+        default=0.0,
+        help="Seconds each fake upstream waits before answering.",
+    )
+    parser.add_argument(
+        "--no-id-token",
+        action="store_true",
+        help="Leave the ID token out of Google's token response to exercise userinfo.",
+    )
+    parser.add_argument(
+        "--discord-oauth",
+        action="store_true",
+        help="Run the optional Discord OAuth leg (DISCORD_OAUTH_REQUIRED=1).",
+    )
+    parser.add_argument(
+        "--state-backend",
+        choices=("memory", "sqlite", "redis"),
+        default="memory",
+        help="Where verification states live; redis runs against bench/fake_redis.py.",
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        run(
+            args.flows,
+            args.concurrency,
+            args.upstream_latency,
+            not args.no_id_token,
+            args.discord_oauth,
+            args.state_backend,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
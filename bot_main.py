@@ -0,0 +1,32 @@
+import asyncio
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+# This is the gateway process whatever .env says; RUN_MODE=web is for the uvicorn workers.
+os.environ["RUN_MODE"] = "bot"
+
+from ipc import IPCServer, bot_handlers
+from shared import bot, processing_states, role_grants, setup_bot, teardown_bot
+
+
+async def main():
+    await setup_bot()
+    ipc_server = IPCServer(
+        os.getenv("IPC_SOCKET_PATH", "instance/bot.sock"),
+        bot_handlers(processing_states, role_grants),
+    )
+    await ipc_server.start()
+    async with bot:
+        try:
+            await bot.start(os.getenv("TOKEN"))
+        finally:
+            await ipc_server.stop()
+            # Pending role grants and logs need the bot's HTTP session, so
+            # finish them before `async with bot` closes it.
+            await teardown_bot()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,11 +2,18 @@ import os
 import re
 import discord
 from discord.ext import commands
-from sqlmodel import Session
-from database import get_session
+from sqlalchemy import delete, insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from database import session_scope
 
-from models import GuildSettings
-from settings_utils import get_settings
+from models import GuildDomain, GuildSettings
+from settings_utils import (
+    cache_settings,
+    get_settings,
+    invalidate_settings,
+    load_settings,
+)
 
 
 class PublicBotCog(commands.Cog):
@@ -15,12 +22,13 @@ class PublicBotCog(commands.Cog):
     def __init__(self, bot) -> None:
         self.bot = bot
 
-    def create_settings(self, session: Session, guild_id: int):
+    def create_settings(self, session: AsyncSession, guild_id: int):
         settings = GuildSettings(
-            allowed_domains_str="",
             guild_id=guild_id,
             verified_role_id="",
             verification_log_channel_id="",
+            # Loaded as empty, so the cached object never lazy-loads after its session.
+            domain_rows=[],
         )
         session.add(settings)
         return settings
@@ -28,24 +36,70 @@ class PublicBotCog(commands.Cog):
     def is_domain_available(self, domain: str):
         return bool(
             re.match(
-                r"^([a-zA-Z0-9][a-zA-Z0-9-]*[a-zA-Z0-9]*\.)+[a-zA-Z]{2,}$",
+                r"^(\*\.)?([a-zA-Z0-9][a-zA-Z0-9-]*[a-zA-Z0-9]*\.)+[a-zA-Z]{2,}$",
                 domain,
             )
         )
 
+    async def reconcile_guilds(self):
+        """Create and delete settings for guilds joined or left while the bot was offline."""
+        joined = {str(guild.id) for guild in self.bot.guilds}
+        async with session_scope() as session:
+            result = await session.exec(select(GuildSettings.guild_id))
+            stored = set(result.all())
+            missing = sorted(joined - stored)
+            orphaned = sorted(stored - joined)
+            if missing:
+                await session.exec(
+                    insert(GuildSettings),
+                    params=[
+                        {
+                            "guild_id": guild_id,
+                            "verified_role_id": "",
+                            "verification_log_channel_id": "",
+                        }
+                        for guild_id in missing
+                    ],
+                )
+            # Chunked to stay below SQLite's bound parameter limit.
+            for start in range(0, len(orphaned), 500):
+                chunk = orphaned[start : start + 500]
+                await session.exec(
+                    delete(GuildDomain).where(GuildDomain.guild_id.in_(chunk))
+                )
+                await session.exec(
+                    delete(GuildSettings).where(GuildSettings.guild_id.in_(chunk))
+                )
+            await session.commit()
+        for guild_id in missing + orphaned:
+            invalidate_settings(guild_id)
+        return missing, orphaned
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        missing, orphaned = await self.reconcile_guilds()
+        if missing or orphaned:
+            print(
+                f"Reconciled guild settings: {len(missing)} created, {len(orphaned)} deleted."
+            )
+
     @commands.Cog.listener()
     async def on_guild_join(self, guild: discord.Guild):
         # Create settings for guild
-        session = next(get_session())
-        self.create_settings(session, guild.id)
-        session.commit()
+        async with session_scope() as session:
+            settings = self.create_settings(session, guild.id)
+            await session.commit()
+        cache_settings(settings)
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild: discord.Guild):
         # Delete settings for guild
-        session = next(get_session())
-        session.delete(get_settings(session, guild.id))
-        session.commit()
+        async with session_scope() as session:
+            settings = await load_settings(session, guild.id)
+            if settings is not None:
+                await session.delete(settings)
+                await session.commit()
+        invalidate_settings(guild.id)
 
     @commands.hybrid_command(
         "role",
@@ -69,10 +123,11 @@ class PublicBotCog(commands.Cog):
                 f"このロールは、{ctx.me.mention}が現在付与されている最も高いロールよりも上位に位置しているため設定できません。\nロールの順序を変更してください。"
             )
             return
-        session = next(get_session())
-        settings = get_settings(session, ctx.guild.id)
-        settings.verified_role_id = role.id
-        session.commit()
+        async with session_scope() as session:
+            settings = await load_settings(session, ctx.guild.id)
+            settings.verified_role_id = role.id
+            await session.commit()
+        cache_settings(settings)
         await ctx.send(
             f"「認証済み」ロールを以下に設定しました: {role.mention}",
             allowed_mentions=discord.AllowedMentions.none(),
@@ -87,10 +142,11 @@ class PublicBotCog(commands.Cog):
     async def set_verification_log_channel(
         self, ctx: commands.Context, channel: discord.TextChannel
     ):
-        session = next(get_session())
-        settings = get_settings(session, ctx.guild.id)
-        settings.verification_log_channel_id = channel.id
-        session.commit()
+        async with session_scope() as session:
+            settings = await load_settings(session, ctx.guild.id)
+            settings.verification_log_channel_id = channel.id
+            await session.commit()
+        cache_settings(settings)
         await ctx.send(f"認証ログチャンネルを以下に設定しました: {channel.mention}")
 
     @commands.hybrid_group("domains", help="認証可能なドメインを構成します。サブコマンドを参照してください。")
@@ -101,50 +157,55 @@ class PublicBotCog(commands.Cog):
 
     @domains_group.command("add", help="認証できるドメインを追加します。")
     async def domains_add_command(self, ctx: commands.Context, domain: str):
+        domain = domain.lower()
         if not self.is_domain_available(domain):
             await ctx.send(f"このドメインは使用できません。")
             return
-        session = next(get_session())
-        settings = get_settings(session, ctx.guild.id)
         domain_limit = int(os.getenv("DOMAIN_LIMITS", 3))
-        if domain_limit <= len(settings.allowed_domains):
-            await ctx.send(
-                f"公開Botでは、認証できるドメインの数は{domain_limit}個までに制限されています。\n既にあるドメインを削除するか、Botの管理者に直接問い合わせてください: {os.getenv('SUPPORT_LINK')}"
-            )
-            return
-        if domain in settings.allowed_domains:
-            await ctx.send(f"既にこのドメインは追加されています: `{domain}`")
-            return
-        settings.add_allowed_domain(domain)
-        session.commit()
+        async with session_scope() as session:
+            settings = await load_settings(session, ctx.guild.id)
+            if domain_limit <= len(settings.allowed_domains):
+                await ctx.send(
+                    f"公開Botでは、認証できるドメインの数は{domain_limit}個までに制限されています。\n既にあるドメインを削除するか、Botの管理者に直接問い合わせてください: {os.getenv('SUPPORT_LINK')}"
+                )
+                return
+            if domain in settings.allowed_domains:
+                await ctx.send(f"既にこのドメインは追加されています: `{domain}`")
+                return
+            settings.add_allowed_domain(domain)
+            await session.commit()
+        cache_settings(settings)
         await ctx.send(f"認証できるドメインに以下を追加しました: `{domain}`")
 
     @domains_group.command("remove", help="認証できるドメインを削除します。")
     async def domains_remove_command(self, ctx: commands.Context, domain: str):
+        domain = domain.lower()
         if not self.is_domain_available(domain):
             await ctx.send(f"このドメインは使用できません。")
             return
-        session = next(get_session())
-        settings = get_settings(session, ctx.guild.id)
-        if domain not in settings.allowed_domains:
-            await ctx.send(f"以下は認証できるドメインではありません: `{domain}`")
-            return
-        settings.remove_allowed_domain(domain)
-        session.commit()
+        async with session_scope() as session:
+            settings = await load_settings(session, ctx.guild.id)
+            if domain not in settings.allowed_domains:
+                await ctx.send(f"以下は認証できるドメインではありません: `{domain}`")
+                return
+            settings.remove_allowed_domain(domain)
+            await session.commit()
+        cache_settings(settings)
         await ctx.send(f"認証できるドメインから以下を削除しました: `{domain}`")
 
     @domains_group.command("clear", help="認証できるドメインをすべて削除（クリア）します。")
     async def domains_clear_command(self, ctx: commands.Context):
-        session = next(get_session())
-        settings = get_settings(session, ctx.guild.id)
-        settings.allowed_domains_str = ""
-        session.commit()
+        async with session_scope() as session:
+            settings = await load_settings(session, ctx.guild.id)
+            settings.set_allowed_domains()
+            await session.commit()
+        cache_settings(settings)
         await ctx.send(f"認証できるドメインをクリアしました。")
 
     @domains_group.command("list", help="認証できるドメインの一覧を表示します。")
     async def domains_list(self, ctx: commands.Context):
-        session = next(get_session())
-        settings = get_settings(session, ctx.guild.id)
+        async with session_scope() as session:
+            settings = await get_settings(session, ctx.guild.id)
         embed = discord.Embed(
             title=f"認証できるドメイン一覧 ({len(settings.allowed_domains)} / {os.getenv('DOMAIN_LIMITS')})"
         )
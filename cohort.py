@@ -0,0 +1,87 @@
+import asyncio
+import csv
+import io
+import re
+from typing import Awaitable, Callable
+
+import discord
+
+SNOWFLAKE = re.compile(r"^\d{17,20}$")
+# guild.query_members accepts at most 100 user IDs per request.
+CHUNK_SIZE = 100
+
+
+class CohortReport:
+    def __init__(self, total: int):
+        self.total = total
+        self.processed = 0
+        self.granted: list[int] = []
+        self.already_verified: list[int] = []
+        self.not_found: list[int] = []
+        self.failed: list[tuple[int, str]] = []
+
+    def to_csv(self) -> str:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["user_id", "result"])
+        for user_id in self.granted:
+            writer.writerow([user_id, "granted"])
+        for user_id in self.already_verified:
+            writer.writerow([user_id, "already_verified"])
+        for user_id in self.not_found:
+            writer.writerow([user_id, "not_found"])
+        for user_id, reason in self.failed:
+            writer.writerow([user_id, reason])
+        return buffer.getvalue()
+
+
+def parse_roster(content: bytes) -> tuple[list[int], int]:
+    """Collect Discord IDs from any cell of a CSV roster. Returns (ids, skipped rows)."""
+    user_ids = {}
+    skipped = 0
+    text = content.decode("utf-8-sig", errors="replace")
+    for row in csv.reader(io.StringIO(text)):
+        ids = [cell.strip() for cell in row if SNOWFLAKE.match(cell.strip())]
+        if not ids:
+            skipped += 1
+        for user_id in ids:
+            user_ids[int(user_id)] = None
+    return list(user_ids), skipped
+
+
+async def grant_cohort(
+    guild: discord.Guild,
+    role: discord.Role,
+    user_ids: list[int],
+    on_progress: Callable[[CohortReport], Awaitable[None]],
+) -> CohortReport:
+    report = CohortReport(len(user_ids))
+    for start in range(0, len(user_ids), CHUNK_SIZE):
+        chunk = user_ids[start : start + CHUNK_SIZE]
+        # One gateway request resolves the whole chunk instead of 100 REST calls.
+        try:
+            members = await guild.query_members(
+                user_ids=chunk, limit=CHUNK_SIZE, cache=False
+            )
+        except asyncio.TimeoutError:
+            # Only this chunk is lost; the rest of the run carries on.
+            report.failed.extend((user_id, "failed: timeout") for user_id in chunk)
+            report.processed += len(chunk)
+            await on_progress(report)
+            continue
+        found = {member.id: member for member in members}
+        for user_id in chunk:
+            member = found.get(user_id)
+            if member is None:
+                report.not_found.append(user_id)
+            elif role in member.roles:
+                report.already_verified.append(user_id)
+            else:
+                try:
+                    await member.add_roles(role, reason="Bulk verification.")
+                    report.granted.append(user_id)
+                except discord.HTTPException as e:
+                    report.failed.append((user_id, f"failed: {e.status}"))
+            report.processed += 1
+        await on_progress(report)
+    return report
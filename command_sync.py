@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+from logging import getLogger
+
+import discord
+from discord import app_commands
+
+logger = getLogger("discord")
+
+
+def tree_hash(tree: app_commands.CommandTree, guild: discord.Object = None) -> str:
+    """Hash of the payload `tree.sync(guild=guild)` would upload."""
+    payload = [command.to_dict(tree) for command in tree.get_commands(guild=guild)]
+    serialized = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+class CommandSyncer:
+    """Syncs the command tree only when it differs from what was last uploaded.
+
+    The hash of every synced scope is kept in `path`, so restarts and gateway
+    reconnects don't repeat the rate-limited bulk overwrite. With
+    `dev_guild_ids`, the global commands are copied to those guilds and only
+    the guild-scoped trees are synced, which Discord applies immediately.
+    """
+
+    def __init__(self, tree: app_commands.CommandTree, path: str, dev_guild_ids=()):
+        self.tree = tree
+        self.path = path
+        self.dev_guild_ids = [int(guild_id) for guild_id in dev_guild_ids]
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, hashes: dict):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(hashes, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
+
+    async def sync(self, application_id: int) -> int:
+        """Sync the scopes whose commands changed and return how many were synced."""
+        if self.dev_guild_ids:
+            guilds = [discord.Object(guild_id) for guild_id in self.dev_guild_ids]
+            for guild in guilds:
+                self.tree.copy_global_to(guild=guild)
+        else:
+            guilds = [None]
+
+        hashes = self._load()
+        synced = 0
+        for guild in guilds:
+            scope = "global" if guild is None else str(guild.id)
+            key = f"{application_id}:{scope}"
+            digest = tree_hash(self.tree, guild)
+            if hashes.get(key) == digest:
+                logger.info(f"Commands for {scope} are up to date, skipping sync.")
+                continue
+            await self.tree.sync(guild=guild)
+            hashes[key] = digest
+            # Saved after each scope so a failure later on doesn't force a resync.
+            self._save(hashes)
+            synced += 1
+            logger.info(f"Synced commands for {scope}.")
+        return synced
@@ -1,21 +1,38 @@
 from configparser import ConfigParser
-from sqlmodel import Session, SQLModel, create_engine
+from contextlib import asynccontextmanager
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from metrics import instrument_engine
 from models import *
 
 alembic_ini = ConfigParser()
 alembic_ini.read("alembic.ini")
 
+database_url = alembic_ini.get("alembic", "sqlalchemy.url")
 connect_args = {"check_same_thread": False}
 engine = create_engine(
-    alembic_ini.get("alembic", "sqlalchemy.url"),
+    database_url,
     connect_args=connect_args,
 )
+async_engine = create_async_engine(
+    database_url.replace("sqlite://", "sqlite+aiosqlite://", 1),
+    connect_args=connect_args,
+)
+instrument_engine(async_engine.sync_engine)
 
 
 def create_db():
     SQLModel.metadata.create_all(engine)
 
 
-def get_session():
-    with Session(engine) as session:
+@asynccontextmanager
+async def session_scope():
+    # Cached GuildSettings outlive their session, so keep attributes loaded after commit.
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
+async def get_session():
+    async with session_scope() as session:
         yield session
@@ -0,0 +1,59 @@
+from functools import lru_cache
+
+_WILDCARD = "*"
+
+
+class DomainMatcher:
+    """Immutable set of allowed domain rules.
+
+    Plain rules (`example.com`) are matched exactly, and wildcard rules
+    (`*.example.com`) match any subdomain through a trie of reversed labels.
+    """
+
+    __slots__ = ("domains", "_exact", "_suffixes")
+
+    def __init__(self, domains):
+        self.domains = tuple(dict.fromkeys(d for d in domains if d))
+        exact = set()
+        suffixes = {}
+        for domain in self.domains:
+            domain = domain.strip().lower()
+            if domain.startswith(_WILDCARD + "."):
+                node = suffixes
+                for label in reversed(domain[2:].split(".")):
+                    node = node.setdefault(label, {})
+                node[_WILDCARD] = True
+            else:
+                exact.add(domain)
+        self._exact = frozenset(exact)
+        self._suffixes = suffixes
+
+    def __bool__(self):
+        return bool(self.domains)
+
+    def __len__(self):
+        return len(self.domains)
+
+    def matches(self, domain: str) -> bool:
+        if not domain:
+            return False
+        domain = domain.lower()
+        if domain in self._exact:
+            return True
+        labels = domain.split(".")
+        node = self._suffixes
+        for depth, label in enumerate(reversed(labels), start=1):
+            node = node.get(label)
+            if node is None:
+                return False
+            if _WILDCARD in node and depth < len(labels):
+                return True
+        return False
+
+
+@lru_cache(maxsize=4096)
+def compile_domain_rules(domains: str | tuple[str, ...]) -> DomainMatcher:
+    """Compile a comma-separated string or a tuple of rules, reusing earlier results."""
+    if isinstance(domains, str):
+        domains = domains.split(",")
+    return DomainMatcher(domains)
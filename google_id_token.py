@@ -0,0 +1,80 @@
+import asyncio
+import re
+import time
+
+import jwt
+
+from http_client import HTTPClient
+
+GOOGLE_ISSUERS = ("https://accounts.google.com", "accounts.google.com")
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class GoogleKeySet:
+    """Google's OAuth signing keys, cached for as long as the certs response allows.
+
+    An unknown `kid` means Google rotated its keys, so the set is refetched
+    early, at most once every `min_refresh_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        http_client: HTTPClient,
+        certs_url: str = "https://www.googleapis.com/oauth2/v3/certs",
+        default_max_age: float = 3600,
+        min_refresh_interval: float = 60,
+    ):
+        self.http_client = http_client
+        self.certs_url = certs_url
+        self.default_max_age = default_max_age
+        self.min_refresh_interval = min_refresh_interval
+        self.keys: dict[str, jwt.PyJWK] = {}
+        self.expires_at = 0.0
+        self.fetched_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def refresh(self):
+        data, headers = await self.http_client.get_json_with_headers(self.certs_url)
+        match = MAX_AGE.search(headers.get("Cache-Control", ""))
+        max_age = int(match.group(1)) if match else self.default_max_age
+        self.keys = {
+            key["kid"]: jwt.PyJWK(key) for key in data["keys"] if key.get("kid")
+        }
+        self.fetched_at = time.monotonic()
+        self.expires_at = self.fetched_at + max_age
+
+    async def get_key(self, kid: str) -> jwt.PyJWK:
+        if time.monotonic() >= self.expires_at or kid not in self.keys:
+            async with self._lock:
+                # Another request may have refreshed the set while we waited.
+                now = time.monotonic()
+                expired = now >= self.expires_at
+                rotated = (
+                    kid not in self.keys
+                    and now - self.fetched_at >= self.min_refresh_interval
+                )
+                if expired or rotated:
+                    await self.refresh()
+        key = self.keys.get(kid)
+        if key is None:
+            raise jwt.InvalidKeyError(f"Unknown signing key: {kid}")
+        return key
+
+
+async def verify_id_token(key_set: GoogleKeySet, id_token: str, audience: str) -> dict:
+    """Verify a Google ID token locally and return its claims."""
+    header = jwt.get_unverified_header(id_token)
+    key = await key_set.get_key(header.get("kid"))
+    claims = jwt.decode(
+        id_token,
+        key.key,
+        algorithms=["RS256"],
+        audience=audience,
+        options={"require": ["exp", "iat", "iss", "aud", "sub"]},
+        leeway=30,
+    )
+    if claims["iss"] not in GOOGLE_ISSUERS:
+        raise jwt.InvalidIssuerError(f"Unexpected issuer: {claims['iss']}")
+    if not claims.get("email_verified"):
+        raise jwt.InvalidTokenError("The email address is not verified.")
+    return claims
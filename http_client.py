@@ -0,0 +1,66 @@
+import os
+
+import aiohttp
+
+
+class HTTPClient:
+    """Shared aiohttp session for the OAuth upstreams (discord.com, googleapis.com).
+
+    The connector keeps connections alive per host, so repeated token exchanges
+    reuse the same TLS connections instead of blocking the event loop.
+    """
+
+    session: aiohttp.ClientSession
+
+    def __init__(self):
+        self.session = None
+
+    async def open(self):
+        if self.session is not None and not self.session.closed:
+            return
+        self.connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+        self.token_timeout = float(os.getenv("HTTP_TOKEN_TIMEOUT", "10"))
+        self.userinfo_timeout = float(os.getenv("HTTP_USERINFO_TIMEOUT", "5"))
+        connector = aiohttp.TCPConnector(
+            limit=int(os.getenv("HTTP_POOL_SIZE", "100")),
+            limit_per_host=int(os.getenv("HTTP_POOL_SIZE_PER_HOST", "30")),
+            keepalive_timeout=30,
+            ttl_dns_cache=300,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, raise_for_status=True
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _timeout(self, total: float):
+        return aiohttp.ClientTimeout(total=total, sock_connect=self.connect_timeout)
+
+    async def post_form(self, url: str, data: dict, timeout: float = None) -> dict:
+        async with self.session.post(
+            url, data=data, timeout=self._timeout(timeout or self.token_timeout)
+        ) as response:
+            return await response.json()
+
+    async def get_json(
+        self, url: str, headers: dict = None, params: dict = None, timeout: float = None
+    ) -> dict:
+        data, _ = await self.get_json_with_headers(url, headers, params, timeout)
+        return data
+
+    async def get_json_with_headers(
+        self, url: str, headers: dict = None, params: dict = None, timeout: float = None
+    ):
+        async with self.session.get(
+            url,
+            headers=headers,
+            params=params,
+            timeout=self._timeout(timeout or self.userinfo_timeout),
+        ) as response:
+            return await response.json(), response.headers
+
+
+http_client = HTTPClient()
@@ -0,0 +1,234 @@
+import asyncio
+import itertools
+import json
+import os
+from logging import getLogger
+from typing import Awaitable, Callable
+
+import metrics
+from role_grants import RoleGrantJob, RoleGrantQueue
+from state_store import StateBackend, VerificationState
+
+logger = getLogger("discord")
+
+Handler = Callable[..., Awaitable[object]]
+
+
+class IPCError(Exception):
+    pass
+
+
+class IPCServer:
+    """Serves newline-delimited JSON requests from web workers on a Unix socket.
+
+    Requests look like `{"id": 1, "op": "state.get", "args": {...}}` and are
+    answered with `{"id": 1, "result": ...}` or `{"id": 1, "error": "..."}`.
+    """
+
+    def __init__(self, path: str, handlers: dict[str, Handler]):
+        self.path = path
+        self.handlers = handlers
+        self.server: asyncio.AbstractServer = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Each request runs in its own task, so a slow handler doesn't hold up
+        # the rest of the worker's calls; responses go out in completion order.
+        write_lock = asyncio.Lock()
+        tasks: set[asyncio.Task] = set()
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("not an object")
+                except ValueError as e:
+                    logger.warning(f"Ignoring a malformed IPC request: {e}")
+                    continue
+                task = asyncio.create_task(self._handle(request, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            # Let requests already received finish, e.g. a queued role grant.
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def _handle(
+        self, request: dict, writer: asyncio.StreamWriter, write_lock: asyncio.Lock
+    ):
+        response = {"id": request.get("id")}
+        try:
+            handler = self.handlers[request["op"]]
+            response["result"] = await handler(**request.get("args", {}))
+        except Exception as e:
+            logger.exception(f"IPC request {request.get('op')} failed")
+            response["error"] = repr(e)
+        async with write_lock:
+            try:
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+
+class IPCClient:
+    """One multiplexed connection from a web worker to the bot process."""
+
+    def __init__(self, path: str, timeout: float = 5):
+        self.path = path
+        self.timeout = timeout
+        self._ids = itertools.count()
+        self._pending: dict[int, asyncio.Future] = {}
+        self._writer: asyncio.StreamWriter = None
+        self._reader_task: asyncio.Task = None
+        self._connect_lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return
+            reader, self._writer = await asyncio.open_unix_connection(self.path)
+            self._reader_task = asyncio.create_task(self._read(reader, self._writer))
+
+    async def _read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                response = json.loads(line)
+                future = self._pending.pop(response["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(IPCError(response["error"]))
+                else:
+                    future.set_result(response.get("result"))
+        finally:
+            writer.close()
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(IPCError("Connection to the bot was lost."))
+            self._pending.clear()
+
+    async def call(self, op: str, **args):
+        await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._writer.write(
+            json.dumps({"id": request_id, "op": op, "args": args}).encode() + b"\n"
+        )
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+
+
+class RemoteStateStore(StateBackend):
+    """StateStore interface backed by the bot process's store."""
+
+    # Changes happen in the bot process, so subscribers just poll sooner.
+    event_poll_interval = 1
+
+    def __init__(self, client: IPCClient):
+        super().__init__()
+        self.client = client
+
+    async def get(self, state: str):
+        data = await self.client.call("state.get", state=state)
+        return VerificationState.from_dict(data) if data else None
+
+    async def peek(self, state: str):
+        data = await self.client.call("state.peek", state=state)
+        return VerificationState.from_dict(data) if data else None
+
+    async def update(self, state: str, **fields):
+        data = await self.client.call("state.update", state=state, fields=fields)
+        self._notify(state)
+        return VerificationState.from_dict(data) if data else None
+
+    async def delete(self, state: str):
+        await self.client.call("state.delete", state=state)
+        self._notify(state)
+
+
+class RemoteRoleGrantQueue:
+    """RoleGrantQueue interface that hands jobs to the bot process."""
+
+    def __init__(self, client: IPCClient):
+        self.client = client
+        self._tasks: set[asyncio.Task] = set()
+
+    def enqueue(self, job: RoleGrantJob):
+        task = asyncio.create_task(
+            self.client.call("role_grants.enqueue", job=job.to_dict())
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Failed to hand a role grant to the bot: {task.exception()!r}")
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def bot_handlers(store: StateBackend, role_grants: RoleGrantQueue) -> dict[str, Handler]:
+    async def state_get(state: str):
+        record = await store.get(state)
+        return record.to_dict() if record else None
+
+    async def state_peek(state: str):
+        record = await store.peek(state)
+        return record.to_dict() if record else None
+
+    async def state_update(state: str, fields: dict):
+        record = await store.update(state, **fields)
+        return record.to_dict() if record else None
+
+    async def state_delete(state: str):
+        await store.delete(state)
+
+    async def role_grants_enqueue(job: dict):
+        role_grants.enqueue(RoleGrantJob(**job))
+
+    async def stats():
+        return {
+            "states": store.stats(),
+            "role_grants": role_grants.stats(),
+            "members": role_grants.members.stats(),
+        }
+
+    async def render_metrics():
+        return metrics.render().decode()
+
+    return {
+        "state.get": state_get,
+        "state.peek": state_peek,
+        "state.update": state_update,
+        "state.delete": state_delete,
+        "role_grants.enqueue": role_grants_enqueue,
+        "stats": stats,
+        "metrics": render_metrics,
+    }
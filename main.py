@@ -3,13 +3,30 @@ import os
 
 from dotenv import load_dotenv
 from fastapi import Depends, FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import Response
 import uvicorn
+from api.admin import router as router_admin
 from api.api_v1 import router as router_v1
-from shared import bot
+from audit_log import audit_log
+from http_client import http_client
+import metrics
+from shared import (
+    bot,
+    bot_client,
+    processing_states,
+    role_grants,
+    run_mode,
+    setup_bot,
+    teardown_bot,
+)
+import settings_utils
+from static_pages import static_pages
 
 load_dotenv()
 
+if run_mode == "bot":
+    raise RuntimeError('RUN_MODE "bot" is for bot_main.py; run the web server as "all" or "web".')
+
 app = FastAPI()
 
 
@@ -19,16 +36,54 @@ def get_bot():
 
 @app.on_event("startup")
 async def startup():
+    await http_client.open()
+    static_pages.load("main", "main.html")
+    static_pages.load("success", "success.html")
+    static_pages.load("failed", "failed.html")
+    app.include_router(router_admin)
     app.include_router(router_v1, dependencies=[Depends(get_bot)])
-    if bool(int(os.getenv("PUBLIC_BOT_FEATURES", "0"))):
-        print("Loading extension for public bot...")
-        await bot.load_extension("cogs.public_bot")
+    if run_mode == "web":
+        # The gateway connection lives in bot_main.py; settings may change there.
+        settings_utils.use_cache = False
+        audit_log.start()
+        return
+    await setup_bot()
     asyncio.create_task(bot.start(os.getenv("TOKEN")))
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    if run_mode == "web":
+        await role_grants.stop()
+        await bot_client.close()
+        await audit_log.stop()
+        await processing_states.close()
+    else:
+        await teardown_bot()
+    await http_client.close()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
+@app.get("/metrics/bot")
+async def get_bot_metrics():
+    # In the split deployment the gateway, role grant and state metrics live in bot_main.py.
+    if run_mode != "web":
+        raise HTTPException(404)
+    return Response(
+        await bot_client.call("metrics"), media_type=metrics.CONTENT_TYPE_LATEST
+    )
+
+
 async def custom_exception_handler(request, exc):
     status_code = exc.status_code if isinstance(exc, HTTPException) else 500
-    return FileResponse("failed.html", status_code=status_code)
+    headers = exc.headers if isinstance(exc, HTTPException) else None
+    return static_pages.response(
+        request, "failed", status_code=status_code, headers=headers
+    )
 
 
 # FastAPIアプリケーションにException Middlewareを追加
@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+
+import discord
+
+
+class MemberCache:
+    """Members fetched over REST, for bots that don't keep every member in memory.
+
+    `guild.get_member` is tried first, so with the full member cache this never
+    fetches anything. Otherwise the member is fetched once and kept for `ttl`
+    seconds, and at most `max_size` members are held at a time, so memory
+    scales with the verifications in progress instead of the guild sizes.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._members: OrderedDict[tuple[int, int], tuple[float, discord.Member]] = (
+            OrderedDict()
+        )
+        self.hits = 0
+        self.fetches = 0
+
+    def __len__(self):
+        return len(self._members)
+
+    async def get(self, guild: discord.Guild, user_id: int) -> discord.Member:
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+        key = (guild.id, user_id)
+        cached = self._members.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            self.hits += 1
+            self._members.move_to_end(key)
+            return cached[1]
+
+        self.fetches += 1
+        member = await guild.fetch_member(user_id)
+        self._members[key] = (time.monotonic() + self.ttl, member)
+        self._members.move_to_end(key)
+        while len(self._members) > self.max_size:
+            self._members.popitem(last=False)
+        return member
+
+    def invalidate(self, guild_id: int, user_id: int):
+        self._members.pop((guild_id, user_id), None)
+
+    def stats(self):
+        return {
+            "size": len(self._members),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "fetches": self.fetches,
+        }
@@ -0,0 +1,105 @@
+import functools
+import os
+import time
+from typing import Callable, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+STAGE_LATENCY = Histogram(
+    "enforcer_stage_duration_seconds",
+    "Time spent in each step of the verification pipeline.",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+FAILURES = Counter(
+    "enforcer_verification_failures_total",
+    "Verification attempts that stopped early, by stage and reason.",
+    ["stage", "reason"],
+)
+DB_QUERY_LATENCY = Histogram(
+    "enforcer_db_query_duration_seconds",
+    "Time spent executing database statements.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+GATEWAY_LATENCY = Gauge(
+    "enforcer_gateway_latency_seconds",
+    "Latency between a gateway heartbeat and its acknowledgement.",
+)
+
+
+class _LiveStatesCollector:
+    def __init__(self, count: Callable[[], Optional[int]]):
+        self.count = count
+
+    def collect(self):
+        value = self.count()
+        # Stores that can't count their states leave the metric out instead of reporting 0.
+        if value is not None:
+            yield GaugeMetricFamily(
+                "enforcer_verification_states",
+                "Live verification sessions in the state store.",
+                value=value,
+            )
+
+
+def track_live_states(count: Callable[[], Optional[int]]):
+    REGISTRY.register(_LiveStatesCollector(count))
+
+
+def stage(name: str):
+    """Context manager that records the duration of a pipeline stage."""
+    return STAGE_LATENCY.labels(name).time()
+
+
+def failure(stage: str, reason: str):
+    FAILURES.labels(stage, reason).inc()
+
+
+def timed(name: str):
+    """Decorator for coroutine functions that records their duration and exceptions."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                with stage(name):
+                    return await func(*args, **kwargs)
+            except Exception as e:
+                failure(name, type(e).__name__)
+                raise
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_engine(engine: Engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._enforcer_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_LATENCY.observe(time.perf_counter() - context._enforcer_started)
+
+
+def render() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Several uvicorn workers: aggregate the files every worker writes.
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
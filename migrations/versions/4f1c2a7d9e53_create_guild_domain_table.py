@@ -0,0 +1,75 @@
+"""Create guild_domain table
+
+Revision ID: 4f1c2a7d9e53
+Revises: b9e8cd620367
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision = "4f1c2a7d9e53"
+down_revision = "b9e8cd620367"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    guild_domain = op.create_table(
+        "guild_domain",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("guild_id", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("domain", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.ForeignKeyConstraint(["guild_id"], ["guildsettings.guild_id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_guild_domain_guild_id_domain",
+        "guild_domain",
+        ["guild_id", "domain"],
+        unique=True,
+    )
+    op.create_index("ix_guild_domain_domain", "guild_domain", ["domain"])
+
+    # Split the comma-joined column into one row per domain.
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.text("SELECT guild_id, allowed_domains FROM guildsettings")
+    ).fetchall()
+    domains = []
+    for guild_id, allowed_domains in rows:
+        for domain in dict.fromkeys((allowed_domains or "").split(",")):
+            if domain:
+                domains.append({"guild_id": guild_id, "domain": domain})
+    if domains:
+        op.bulk_insert(guild_domain, domains)
+
+    with op.batch_alter_table("guildsettings") as batch_op:
+        batch_op.drop_column("allowed_domains")
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("guildsettings") as batch_op:
+        batch_op.add_column(sa.Column("allowed_domains", sa.String(), nullable=True))
+
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.text("SELECT guild_id, domain FROM guild_domain ORDER BY id")
+    ).fetchall()
+    joined = {}
+    for guild_id, domain in rows:
+        joined.setdefault(guild_id, []).append(domain)
+    for guild_id, domains in joined.items():
+        connection.execute(
+            sa.text(
+                "UPDATE guildsettings SET allowed_domains = :domains"
+                " WHERE guild_id = :guild_id"
+            ),
+            {"domains": ",".join(domains), "guild_id": guild_id},
+        )
+
+    op.drop_index("ix_guild_domain_domain", table_name="guild_domain")
+    op.drop_index("ix_guild_domain_guild_id_domain", table_name="guild_domain")
+    op.drop_table("guild_domain")
@@ -0,0 +1,44 @@
+"""Create verification_event table
+
+Revision ID: 7a3e5c1b2d84
+Revises: 4f1c2a7d9e53
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision = "7a3e5c1b2d84"
+down_revision = "4f1c2a7d9e53"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "verification_event",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("guild_id", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("user_id", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column(
+            "email_domain_hash", sqlmodel.sql.sqltypes.AutoString(), nullable=True
+        ),
+        sa.Column("outcome", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("timings", sa.JSON(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_verification_event_guild_id_created_at",
+        "verification_event",
+        ["guild_id", "created_at"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        "ix_verification_event_guild_id_created_at", table_name="verification_event"
+    )
+    op.drop_table("verification_event")
@@ -1,39 +1,83 @@
+from datetime import datetime, timezone
 from enum import Enum
+from typing import Optional
 import discord
-from sqlalchemy import Column, String
-from sqlmodel import Field, SQLModel
+from sqlalchemy import JSON, Column, Index
+from sqlmodel import Field, Relationship, SQLModel
+
+from domain_rules import DomainMatcher, compile_domain_rules
+
+
+class GuildDomain(SQLModel, table=True):
+    __tablename__ = "guild_domain"
+    __table_args__ = (
+        Index("ix_guild_domain_guild_id_domain", "guild_id", "domain", unique=True),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    guild_id: str = Field(foreign_key="guildsettings.guild_id")
+    domain: str = Field(index=True)
+
+    guild: Optional["GuildSettings"] = Relationship(back_populates="domain_rows")
 
 
 class GuildSettings(SQLModel, table=True):
     guild_id: str = Field(default=None, primary_key=True)
-    allowed_domains_str: str = Field(
-        sa_column=Column("allowed_domains", String, default=None)
-    )
     verified_role_id: str = Field(default=None)
     verification_log_channel_id: str = Field(default=None)
 
+    domain_rows: list[GuildDomain] = Relationship(
+        back_populates="guild",
+        sa_relationship_kwargs={
+            "lazy": "selectin",
+            "cascade": "all, delete-orphan",
+            "order_by": "GuildDomain.id",
+        },
+    )
+
+    @property
+    def domain_matcher(self) -> DomainMatcher:
+        # Kept on the instance state so it is compiled once per loaded row set.
+        info = self._sa_instance_state.info
+        matcher = info.get("domain_matcher")
+        if matcher is None:
+            matcher = info["domain_matcher"] = compile_domain_rules(
+                tuple(row.domain for row in self.domain_rows)
+            )
+        return matcher
+
     @property
     def allowed_domains(self):
-        if self.allowed_domains_str:
-            return self.allowed_domains_str.split(",")
-        else:
-            return []
+        return self.domain_matcher.domains
 
     def set_allowed_domains(self, *domains):
-        self.allowed_domains_str = ",".join(set(domains))
+        rows = {row.domain: row for row in self.domain_rows}
+        self.domain_rows = [
+            rows.get(domain) or GuildDomain(domain=domain)
+            for domain in dict.fromkeys(domains)
+            if domain
+        ]
+        self._sa_instance_state.info.pop("domain_matcher", None)
 
     def add_allowed_domain(self, domain):
-        self.set_allowed_domains(*((*self.allowed_domains, domain)))
+        if domain not in self.allowed_domains:
+            self.domain_rows.append(GuildDomain(domain=domain))
+            self._sa_instance_state.info.pop("domain_matcher", None)
 
     def remove_allowed_domain(self, domain):
-        self.set_allowed_domains(*[d for d in self.allowed_domains if d != domain])
+        for row in self.domain_rows:
+            if row.domain == domain:
+                self.domain_rows.remove(row)
+                self._sa_instance_state.info.pop("domain_matcher", None)
+                break
 
     @property
     def friendly_allowed_domains(self):
         return ", ".join(self.allowed_domains)
 
     def is_allowed(self, domain):
-        return domain in self.allowed_domains if self.allowed_domains else True
+        matcher = self.domain_matcher
+        return matcher.matches(domain) if matcher else True
 
     def validate_settings(self, bot: discord.Client):
         result = SettingsValidationResult()
@@ -101,6 +145,36 @@ class GuildSettings(SQLModel, table=True):
         return result
 
 
+class VerificationEvent(SQLModel, table=True):
+    """One finished verification attempt, written in batches by audit_log.AuditLog."""
+
+    __tablename__ = "verification_event"
+    __table_args__ = (
+        Index("ix_verification_event_guild_id_created_at", "guild_id", "created_at"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    guild_id: str
+    user_id: str
+    # Keyed hash of the Google Workspace domain, see audit_log.hash_email_domain().
+    email_domain_hash: Optional[str] = Field(default=None)
+    outcome: str
+    # Stage name -> milliseconds spent in it.
+    timings: dict = Field(default_factory=dict, sa_column=Column(JSON, nullable=False))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "guild_id": self.guild_id,
+            "user_id": self.user_id,
+            "email_domain_hash": self.email_domain_hash,
+            "outcome": self.outcome,
+            "timings": self.timings,
+            "created_at": self.created_at.isoformat(),
+        }
+
+
 class SettingsValidationTag(Enum):
     NOT_FOUND = "Not Found: 見つからないか、削除されています。"
     NO_PERMISSION = "No Permission: 権限がありません。"
@@ -118,10 +192,12 @@ class SettingsValidationResult:
     verified_role_grantable: bool
     verified_role_reasons: list[SettingsValidationTag]
     domains: list[str]
+    checked_at: datetime
 
     def __init__(self):
         self.log_channel_reasons = []
         self.verified_role_reasons = []
+        self.checked_at = datetime.now(timezone.utc)
 
     @property
     def is_valid(self):
@@ -0,0 +1,80 @@
+import math
+import os
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class RateLimiter:
+    """Token buckets per key: `burst` requests at once, refilled at `rate` per second.
+
+    Only the `max_keys` most recently used buckets are kept. A bucket that was
+    dropped starts full again, which only ever errs on the side of allowing.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[object, tuple[float, float]] = OrderedDict()
+        self.rejected = 0
+
+    def acquire(self, key) -> float:
+        """Take a token. Returns 0 when allowed, otherwise seconds until one is available."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            retry_after = 0.0
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / self.rate
+            self.rejected += 1
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+class ConcurrencyLimit:
+    """Admission control: at most `limit` holders at a time, extra callers are turned away."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.rejected = 0
+
+    def try_acquire(self) -> bool:
+        if self.active >= self.limit:
+            self.rejected += 1
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+
+
+def retry_after_header(seconds: float) -> dict:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+def _limiter(name: str, rate: str, burst: str) -> RateLimiter:
+    return RateLimiter(
+        rate=float(os.getenv(f"RATE_LIMIT_{name}_RATE", rate)),
+        burst=float(os.getenv(f"RATE_LIMIT_{name}_BURST", burst)),
+    )
+
+
+# Many students can share one school IP, so the per-IP bucket is the loosest.
+ip_limiter = _limiter("IP", "10", "100")
+user_limiter = _limiter("USER", "2", "20")
+guild_limiter = _limiter("GUILD", "50", "500")
+# Clicks on the verification button, per Discord user.
+click_limiter = _limiter("CLICK", "0.1", "3")
+# OAuth callbacks and /validate in flight at once (per process).
+callback_admission = ConcurrencyLimit(int(os.getenv("MAX_CONCURRENT_CALLBACKS", "200")))
@@ -0,0 +1,258 @@
+import asyncio
+import random
+import time
+from collections import defaultdict, deque
+from logging import getLogger
+from typing import Awaitable, Callable
+
+import discord
+
+from member_cache import MemberCache
+from metrics import failure, stage
+from verification_log import VerificationLog
+
+logger = getLogger("discord")
+
+
+class PermanentGrantError(Exception):
+    """The job can never succeed, e.g. the guild or the role no longer exists."""
+
+
+class RoleGrantJob:
+    __slots__ = (
+        "guild_id",
+        "user_id",
+        "role_id",
+        "log_channel_id",
+        "state",
+        "audit",
+        "attempts",
+        "created_at",
+    )
+
+    def __init__(
+        self,
+        guild_id: int,
+        user_id: int,
+        role_id: int,
+        log_channel_id: int,
+        state: str = None,
+        audit: dict = None,
+    ):
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.role_id = role_id
+        self.log_channel_id = log_channel_id
+        self.state = state
+        # email_domain_hash and timings for the audit log entry written when the job finishes.
+        self.audit = audit
+        self.attempts = 0
+        self.created_at = time.monotonic()
+
+    def to_dict(self):
+        return {
+            "guild_id": self.guild_id,
+            "user_id": self.user_id,
+            "role_id": self.role_id,
+            "log_channel_id": self.log_channel_id,
+            "state": self.state,
+            "audit": self.audit,
+        }
+
+
+class RoleGrantQueue:
+    """Grants the verified role outside of the /validate request.
+
+    discord.py already waits on Discord's rate limit buckets, so the queue only
+    makes sure a single worker at a time talks to a given guild's member route.
+    Other workers keep draining jobs for other
+    guilds instead of piling up behind the same bucket.
+    """
+
+    def __init__(
+        self,
+        bot: discord.Client,
+        verification_log: VerificationLog,
+        on_done: Callable[[RoleGrantJob, bool], Awaitable[None]] = None,
+        members: MemberCache = None,
+        workers: int = 4,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        drain_timeout: float = 10.0,
+    ):
+        self.bot = bot
+        self.verification_log = verification_log
+        self.on_done = on_done
+        self.members = members or MemberCache()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.drain_timeout = drain_timeout
+        self.queue: asyncio.Queue[RoleGrantJob] = None
+        self.dead_letters: deque[tuple[RoleGrantJob, str]] = deque(maxlen=1000)
+        self._tasks: list[asyncio.Task] = []
+        self._retry_tasks: set[asyncio.Task] = set()
+        self._guild_locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # States with a job queued, waiting to retry or running.
+        self._pending_states: set[str] = set()
+        # Every job not finished yet, so stop() can account for what it drops.
+        self._unfinished: set[RoleGrantJob] = set()
+        # Set by stop(); retries skip the rest of their backoff.
+        self._draining = asyncio.Event()
+        self.in_flight = 0
+        self.waiting_retry = 0
+        self.granted = 0
+        self.retried = 0
+        self.failed = 0
+        self.duplicates = 0
+
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        for _ in range(self.workers - len(self._tasks)):
+            self._tasks.append(asyncio.create_task(self._work()))
+
+    async def stop(self):
+        """Finish the remaining jobs for up to `drain_timeout` seconds, then cancel the workers.
+
+        /validate has already sent these users to /success, so jobs still left
+        after that are dead-lettered rather than silently dropped.
+        """
+        if self._tasks and self._unfinished:
+            self._draining.set()
+            try:
+                await asyncio.wait_for(self._drain(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                pass
+        tasks = [*self._tasks, *self._retry_tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        if self._unfinished:
+            logger.warning(
+                f"Stopping with {len(self._unfinished)} role grants unfinished"
+            )
+        for job in list(self._unfinished):
+            await self._dead_letter(
+                job, PermanentGrantError("Stopped before the role was granted")
+            )
+
+    async def _drain(self):
+        while True:
+            await self.queue.join()
+            if not self._retry_tasks:
+                return
+            # A retry puts its job back on the queue before it finishes.
+            await asyncio.gather(*self._retry_tasks, return_exceptions=True)
+
+    def enqueue(self, job: RoleGrantJob):
+        if job.state is not None:
+            # /validate may run in several web workers for the same state.
+            if job.state in self._pending_states:
+                self.duplicates += 1
+                return
+            self._pending_states.add(job.state)
+        self._unfinished.add(job)
+        self.queue.put_nowait(job)
+
+    async def _work(self):
+        while True:
+            job = await self.queue.get()
+            self.in_flight += 1
+            try:
+                await self._run(job)
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+
+    async def _run(self, job: RoleGrantJob):
+        job.attempts += 1
+        try:
+            member = await self.grant(job)
+        except (discord.Forbidden, discord.NotFound, PermanentGrantError) as e:
+            await self._dead_letter(job, e)
+        except (discord.HTTPException, asyncio.TimeoutError, OSError) as e:
+            if job.attempts >= self.max_attempts:
+                await self._dead_letter(job, e)
+            else:
+                self.retried += 1
+                task = asyncio.create_task(self._retry_later(job))
+                self._retry_tasks.add(task)
+                task.add_done_callback(self._retry_tasks.discard)
+        except Exception as e:
+            logger.exception("Unexpected error while granting a role")
+            await self._dead_letter(job, e)
+        else:
+            self.granted += 1
+            # The role is in place; a log message that can't be delivered doesn't change that.
+            try:
+                with stage("log_send"):
+                    await self.verification_log.log(job.log_channel_id, member.mention)
+            except Exception:
+                logger.exception("Unexpected error while sending the verification log")
+            await self._done(job, True)
+
+    async def _retry_later(self, job: RoleGrantJob):
+        delay = min(self.max_delay, self.base_delay * 2 ** (job.attempts - 1))
+        self.waiting_retry += 1
+        try:
+            await asyncio.wait_for(
+                self._draining.wait(), delay * random.uniform(0.5, 1.0)
+            )
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.waiting_retry -= 1
+        self.queue.put_nowait(job)
+
+    async def _done(self, job: RoleGrantJob, granted: bool):
+        self._pending_states.discard(job.state)
+        self._unfinished.discard(job)
+        if self.on_done is None:
+            return
+        try:
+            await self.on_done(job, granted)
+        except Exception:
+            logger.exception("Role grant completion callback failed")
+
+    async def _dead_letter(self, job: RoleGrantJob, error: Exception):
+        reason = f"{type(error).__name__}: {error}"
+        self.failed += 1
+        failure("role_grant", type(error).__name__)
+        self.dead_letters.append((job, reason))
+        logger.warning(
+            f"Failed to grant role {job.role_id} to {job.user_id} in {job.guild_id}: {reason}"
+        )
+        await self._done(job, False)
+
+    async def grant(self, job: RoleGrantJob):
+        guild = self.bot.get_guild(job.guild_id)
+        if guild is None:
+            raise PermanentGrantError("Unknown Guild")
+        role = guild.get_role(job.role_id)
+        if role is None:
+            raise PermanentGrantError("Unknown Role")
+        async with self._guild_locks[job.guild_id]:
+            member = await self.members.get(guild, job.user_id)
+            if role not in member.roles:
+                with stage("role_grant"):
+                    await member.add_roles(role, reason="Verification completed.")
+                # add_roles doesn't update the fetched copy.
+                self.members.invalidate(job.guild_id, job.user_id)
+        return member
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "in_flight": self.in_flight,
+            "waiting_retry": self.waiting_retry,
+            "granted": self.granted,
+            "retried": self.retried,
+            "failed": self.failed,
+            "dead_letters": len(self.dead_letters),
+            "duplicates": self.duplicates,
+        }
+
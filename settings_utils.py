@@ -1,24 +1,97 @@
 import os
 
+import discord
 from dotenv import load_dotenv
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from models import GuildSettings
+from models import GuildDomain, GuildSettings, SettingsValidationResult
 
 load_dotenv()
 allowed_domains = os.getenv("DOMAINS", "").split(",")
 public_bot = bool(int(os.getenv("PUBLIC_BOT_FEATURES", "0")))
 
+# guild_id -> GuildSettings. Filled by warm_cache() at startup and kept in sync
+# by the settings commands through cache_settings()/invalidate_settings().
+_settings_cache: dict[int, GuildSettings] = {}
+# Web workers in the split deployment read through to the database instead.
+use_cache = True
+# guild_id -> result of GuildSettings.validate_settings(). Dropped by settings
+# writes and by the gateway events that can change the result (see shared.py).
+_validation_cache: dict[int, SettingsValidationResult] = {}
 
-def get_settings(session: Session, guild_id: int):
+
+async def load_settings(session: AsyncSession, guild_id: int):
+    """Read the settings bypassing the cache. Use this before modifying them."""
     if public_bot:
-        return session.exec(
+        result = await session.exec(
             select(GuildSettings).where(GuildSettings.guild_id == str(guild_id))
-        ).first()
+        )
+        return result.first()
     else:
-        return GuildSettings(
+        settings = GuildSettings(
             guild_id=guild_id,
-            allowed_domains_str=os.getenv("DOMAINS", ""),
             verified_role_id=os.getenv("VERIFIED_ROLE_ID"),
             verification_log_channel_id=os.getenv("VERIFICATION_LOG_CHANNEL_ID"),
         )
+        settings.set_allowed_domains(*os.getenv("DOMAINS", "").split(","))
+        return settings
+
+
+async def get_settings(session: AsyncSession, guild_id: int):
+    if not use_cache:
+        return await load_settings(session, guild_id)
+    settings = _settings_cache.get(int(guild_id))
+    if settings is None:
+        settings = await load_settings(session, guild_id)
+        if settings is not None:
+            _settings_cache[int(guild_id)] = settings
+    return settings
+
+
+async def warm_cache(session: AsyncSession):
+    if not public_bot:
+        return
+    result = await session.exec(select(GuildSettings))
+    for settings in result.all():
+        _settings_cache[int(settings.guild_id)] = settings
+
+
+def cache_settings(settings: GuildSettings):
+    _settings_cache[int(settings.guild_id)] = settings
+    invalidate_validation(settings.guild_id)
+
+
+def invalidate_settings(guild_id: int):
+    _settings_cache.pop(int(guild_id), None)
+    invalidate_validation(guild_id)
+
+
+def validate_settings(settings: GuildSettings, bot: discord.Client):
+    """Cached GuildSettings.validate_settings(). `checked_at` tells when it last ran."""
+    result = _validation_cache.get(int(settings.guild_id))
+    if result is None:
+        result = settings.validate_settings(bot)
+        _validation_cache[int(settings.guild_id)] = result
+    return result
+
+
+def invalidate_validation(guild_id: int = None):
+    if guild_id is None:
+        _validation_cache.clear()
+    else:
+        _validation_cache.pop(int(guild_id), None)
+
+
+async def guilds_allowing_domain(session: AsyncSession, domain: str) -> list[str]:
+    """Guild IDs whose rules accept `domain`, as an indexed lookup on guild_domain."""
+    labels = domain.lower().split(".")
+    candidates = [domain.lower()] + [
+        "*." + ".".join(labels[i:]) for i in range(1, len(labels))
+    ]
+    result = await session.exec(
+        select(GuildDomain.guild_id)
+        .where(GuildDomain.domain.in_(candidates))
+        .distinct()
+    )
+    return result.all()
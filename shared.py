@@ -1,44 +1,182 @@
+import io
+import math
+import time
 from logging import getLogger
 import os
-from uuid import uuid4
 import discord
 from discord.ext import commands
 from discord import Intents
 from discord.ext.commands import Context
-from database import get_session
-from settings_utils import get_settings
+from audit_log import audit_log
+from cohort import CohortReport, grant_cohort, parse_roster
+from command_sync import CommandSyncer
+from database import session_scope
+from ipc import IPCClient, RemoteRoleGrantQueue, RemoteStateStore
+from member_cache import MemberCache
+from metrics import GATEWAY_LATENCY, failure, timed, track_live_states
+from rate_limit import click_limiter, guild_limiter
+from role_grants import RoleGrantQueue
+import settings_utils
+from settings_utils import get_settings, invalidate_validation, validate_settings
+from state_backends import create_state_store
+from state_store import VerificationState
+from state_token import state_tokens
+from verification_log import VerificationLog
 
 from views import RoleView, VerifyView
 import logging
 
-processing_states = {}
+# "all": bot and web in one process, "bot": gateway process only (bot_main.py),
+# "web": stateless web worker that reaches the bot process over IPC.
+run_mode = os.getenv("RUN_MODE", "all")
+if run_mode not in ("all", "bot", "web"):
+    raise ValueError(f"Unknown RUN_MODE: {run_mode}")
+public_bot = bool(int(os.getenv("PUBLIC_BOT_FEATURES", "0")))
+# The state already identifies the Discord user; OAuth only re-confirms it.
+discord_oauth_required = bool(int(os.getenv("DISCORD_OAUTH_REQUIRED", "0")))
 
+# "full" keeps every member in memory, "minimal" fetches members when they verify.
+member_cache_mode = os.getenv("MEMBER_CACHE_MODE", "full")
 
 intent = Intents.default()
 intent.members = True
-bot = commands.Bot(command_prefix="!", intents=intent)
+if member_cache_mode == "minimal":
+    bot = commands.Bot(
+        command_prefix="!",
+        intents=intent,
+        chunk_guilds_at_startup=False,
+        # The bot's own member is always cached, so guild.me keeps working.
+        member_cache_flags=discord.MemberCacheFlags.none(),
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intent)
+members = MemberCache(
+    max_size=int(os.getenv("MEMBER_CACHE_MAX_SIZE", "1000")),
+    ttl=float(os.getenv("MEMBER_CACHE_TTL", "300")),
+)
 bot.remove_command("help")
+command_syncer = CommandSyncer(
+    bot.tree,
+    os.getenv("COMMAND_SYNC_STATE_PATH", "instance/command_sync.json"),
+    dev_guild_ids=[
+        guild_id for guild_id in os.getenv("DEV_GUILD_IDS", "").split(",") if guild_id
+    ],
+)
+verification_log = VerificationLog(
+    bot,
+    mode=os.getenv("VERIFICATION_LOG_MODE", "single"),
+    interval=float(os.getenv("VERIFICATION_LOG_INTERVAL", "10")),
+    batch_size=int(os.getenv("VERIFICATION_LOG_BATCH_SIZE", "50")),
+)
+# "memory" keeps states in the bot process; "sqlite" and "redis" share them
+# between processes, so web workers read and write them directly.
+state_backend = os.getenv("STATE_BACKEND", "memory")
+if run_mode == "web":
+    bot_client = IPCClient(
+        os.getenv("IPC_SOCKET_PATH", "instance/bot.sock"),
+        timeout=float(os.getenv("IPC_TIMEOUT", "5")),
+    )
+    if state_backend == "memory":
+        processing_states = RemoteStateStore(bot_client)
+    else:
+        processing_states = create_state_store(state_backend)
+    role_grants = RemoteRoleGrantQueue(bot_client)
+else:
+    bot_client = None
+    processing_states = create_state_store(state_backend)
+
+    async def on_role_grant_done(job, granted: bool):
+        if job.state is not None:
+            await processing_states.update(
+                job.state, status="granted" if granted else "failed"
+            )
+        if job.audit is not None:
+            audit_log.record(
+                job.guild_id,
+                job.user_id,
+                "granted" if granted else "failed",
+                job.audit["email_domain_hash"],
+                {
+                    **job.audit["timings"],
+                    "role_grant": round((time.monotonic() - job.created_at) * 1000, 1),
+                },
+            )
+
+    role_grants = RoleGrantQueue(
+        bot,
+        verification_log,
+        on_done=on_role_grant_done,
+        members=members,
+        workers=int(os.getenv("ROLE_GRANT_WORKERS", "4")),
+        max_attempts=int(os.getenv("ROLE_GRANT_MAX_ATTEMPTS", "5")),
+        drain_timeout=float(os.getenv("ROLE_GRANT_DRAIN_TIMEOUT", "10")),
+    )
+    track_live_states(processing_states.live_count)
+    GATEWAY_LATENCY.set_function(lambda: bot.latency)
 logger = getLogger("discord")
 logger.setLevel(logging.WARNING)
 stream_handler = logging.StreamHandler()
 logger.addHandler(stream_handler)
 
 
+async def reusable_state(guild_id: int, user_id: int):
+    """The user's live state, if pressing the button again should hand out the same URL."""
+    found = await processing_states.find(guild_id, user_id)
+    if found is None:
+        return None
+    state, verification_state = found
+    # Finished sessions start over; so do URLs that would expire within one TTL.
+    if verification_state.status not in (None, "verified"):
+        return None
+    identity = state_tokens.verify(state)
+    if identity is None or identity[2] - time.time() < processing_states.ttl:
+        return None
+    return state
+
+
+@timed("start_verification")
 async def start_verification(interaction: discord.Interaction):
-    state = str(uuid4())
-    settings = get_settings(next(get_session()), interaction.guild.id)
-    if not settings.validate_settings(interaction.client).is_valid:
+    retry_after = click_limiter.acquire(interaction.user.id) or guild_limiter.acquire(
+        interaction.guild.id
+    )
+    if retry_after:
+        failure("start_verification", "rate_limited")
+        await interaction.response.send_message(
+            f"認証の開始が多すぎます。{math.ceil(retry_after)}秒ほど待ってからもう一度お試しください。",
+            ephemeral=True,
+        )
+        return
+    async with session_scope() as session:
+        settings = await get_settings(session, interaction.guild.id)
+    if not validate_settings(settings, interaction.client).is_valid:
+        failure("start_verification", "invalid_settings")
         message_prefix = ""
         await interaction.response.send_message(
             f"一部の設定が間違っているため、認証を開始できません。\nサーバーの管理者にお問い合わせください。\n\nもしあなたがサーバーの管理者なら、`/settings`を実行して設定を確認してください。",
             ephemeral=True,
         )
         return
-    processing_states[state] = {
-        "guild_name": interaction.guild.name,
-        "domain": settings.allowed_domains,
-        "guild_id": interaction.guild.id,
-    }
+    state = await reusable_state(interaction.guild.id, interaction.user.id)
+    if state is not None:
+        # find() already refreshed its TTL; pick up any settings change.
+        await processing_states.update(
+            state, guild_name=interaction.guild.name, domain=settings.allowed_domains
+        )
+    else:
+        state = state_tokens.issue(interaction.guild.id, interaction.user.id)
+        verification_state = VerificationState(
+            guild_name=interaction.guild.name,
+            domain=settings.allowed_domains,
+            guild_id=interaction.guild.id,
+            user_id=interaction.user.id,
+        )
+        if not discord_oauth_required:
+            verification_state.discord = {
+                "id": str(interaction.user.id),
+                "username": interaction.user.name,
+                "global_name": interaction.user.global_name,
+            }
+        await processing_states.create(state, verification_state)
     url = os.getenv("HOST") + "/" + state
     message_prefix = (
         "認証を開始します！以下のURLにアクセスして、あなたがGoogle Workspaceのアカウントに関連付けられている人物かを認証してください。"
@@ -59,12 +197,75 @@ bot.add_view(VerifyView(start_verification))
 bot.add_view(RoleView())
 
 
+async def setup_bot():
+    """Prepare the bot and its background workers. The caller starts the gateway connection."""
+    if public_bot:
+        print("Loading extension for public bot...")
+        await bot.load_extension("cogs.public_bot")
+        async with session_scope() as session:
+            await settings_utils.warm_cache(session)
+    processing_states.start_sweeper(float(os.getenv("STATE_SWEEP_INTERVAL", "60")))
+    role_grants.start()
+    verification_log.start()
+    audit_log.start()
+
+
+async def teardown_bot():
+    processing_states.stop_sweeper()
+    await role_grants.stop()
+    await verification_log.stop()
+    await audit_log.stop()
+    await processing_states.close()
+
+
 @bot.event
 async def on_ready():
-    await bot.tree.sync()
+    # A fresh session replaces the guild objects the cached results point to.
+    invalidate_validation()
+    # on_ready fires again after every reconnect, the commands only need checking once.
+    if not getattr(bot, "commands_synced", False):
+        bot.commands_synced = True
+        await command_syncer.sync(bot.application_id)
     print("Bot is ready!")
 
 
+@bot.event
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    members.invalidate(payload.guild_id, payload.user.id)
+
+
+# Events that can change the outcome of validate_settings().
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    invalidate_validation(after.guild.id)
+
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    invalidate_validation(role.guild.id)
+
+
+@bot.event
+async def on_guild_channel_update(before, after: discord.abc.GuildChannel):
+    invalidate_validation(after.guild.id)
+
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    invalidate_validation(channel.guild.id)
+
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if after.id == bot.user.id:
+        invalidate_validation(after.guild.id)
+
+
+@bot.event
+async def on_guild_update(before: discord.Guild, after: discord.Guild):
+    invalidate_validation(after.id)
+
+
 @bot.hybrid_command(
     "panel",
     help="認証用のパネルを設置します。チャンネルが指定されればそこへ、指定されなければ実行したチャンネルに送信されます。",
@@ -72,7 +273,8 @@ async def on_ready():
 @discord.app_commands.default_permissions(manage_messages=True)
 @discord.app_commands.guild_only()
 async def create_panel(ctx: Context, channel: discord.TextChannel = None):
-    settings = get_settings(next(get_session()), ctx.guild.id)
+    async with session_scope() as session:
+        settings = await get_settings(session, ctx.guild.id)
     embed = discord.Embed(title="Google Workspaceの認証")
     embed.description = f"このBotは、あなたが{settings.friendly_allowed_domains}{'のいずれか' if len(settings.allowed_domains) > 1 else ''}に所属するメンバーかどうかを確認し、専用のロール（役職）を付与します。\n下のボタンを押すか、`/verify`を実行して認証を開始してください！"
     if channel is None:
@@ -83,6 +285,72 @@ async def create_panel(ctx: Context, channel: discord.TextChannel = None):
     )
 
 
+@bot.hybrid_command(
+    "bulkverify",
+    help="CSVファイルに記載されたDiscord IDのメンバーに「認証済み」ロールを一括で付与します。",
+)
+@discord.app_commands.default_permissions(administrator=True)
+@discord.app_commands.guild_only()
+@commands.has_guild_permissions(administrator=True)
+async def bulk_verify(ctx: Context, roster: discord.Attachment):
+    async with session_scope() as session:
+        settings = await get_settings(session, ctx.guild.id)
+    result = validate_settings(settings, ctx.bot)
+    if not result.verified_role_grantable:
+        await ctx.send(
+            "「認証済み」ロールを付与できません。`/settings`を実行して設定を確認してください。",
+            ephemeral=True,
+        )
+        return
+    user_ids, skipped = parse_roster(await roster.read())
+    if not user_ids:
+        await ctx.send("CSVファイルからDiscord IDが見つかりませんでした。", ephemeral=True)
+        return
+
+    await ctx.defer(ephemeral=True)
+    # A channel message rather than an interaction followup: the followup's
+    # webhook token expires after 15 minutes, which a large roster can outlast.
+    try:
+        progress_message = await ctx.channel.send(
+            f"一括認証を開始します... (0 / {len(user_ids)})"
+        )
+    except discord.HTTPException:
+        await ctx.send("このチャンネルにメッセージを送信できません。", ephemeral=True)
+        return
+    await ctx.send("一括認証を開始しました。進捗と結果はこのチャンネルに投稿されます。", ephemeral=True)
+
+    async def on_progress(report: CohortReport):
+        try:
+            await progress_message.edit(
+                content=f"一括認証を実行中です... ({report.processed} / {report.total})"
+            )
+        except discord.HTTPException:
+            # Progress is cosmetic; the final report is still sent.
+            pass
+
+    report = await grant_cohort(ctx.guild, result.verified_role, user_ids, on_progress)
+    content = f"""一括認証が完了しました！
+付与: {len(report.granted)}人
+既に認証済み: {len(report.already_verified)}人
+サーバーにいないメンバー: {len(report.not_found)}人
+失敗: {len(report.failed)}人
+IDが含まれない行: {skipped}行"""
+    csv_report = report.to_csv().encode()
+    try:
+        await progress_message.edit(
+            content=content,
+            attachments=[
+                discord.File(io.BytesIO(csv_report), filename="bulkverify-report.csv")
+            ],
+        )
+    except discord.NotFound:
+        # The progress message was deleted during the run.
+        await ctx.channel.send(
+            content,
+            file=discord.File(io.BytesIO(csv_report), filename="bulkverify-report.csv"),
+        )
+
+
 @bot.hybrid_command("verify", help="認証用のURLを発行し、認証を開始します。")
 @discord.app_commands.guild_only()
 async def verify(ctx: Context):
@@ -92,14 +360,15 @@ async def verify(ctx: Context):
 @bot.hybrid_command("settings", help="設定を確認します。")
 @discord.app_commands.default_permissions(manage_guild=True)
 @discord.app_commands.guild_only()
-async def validate_settings(ctx: Context):
+async def settings_command(ctx: Context):
     embed = discord.Embed(title="Settings Validator")
     embed.set_footer(
         text="この機能は簡易チェックを目的としています。一度認証を試してみることをおすすめします！",
         icon_url=ctx.bot.user.avatar.url if ctx.bot.user.avatar else None,
     )
-    settings = get_settings(next(get_session()), ctx.guild.id)
-    result = settings.validate_settings(ctx.bot)
+    async with session_scope() as session:
+        settings = await get_settings(session, ctx.guild.id)
+    result = validate_settings(settings, ctx.bot)
 
     def bool_to_str(b: bool) -> str:
         return ":white_check_mark: 利用可能" if b else ":no_entry_sign: 利用不可"
@@ -130,6 +399,10 @@ async def validate_settings(ctx: Context):
 
         __**ドメイン**__
         認証可能なドメイン: {settings.friendly_allowed_domains}
+
+        -------
+
+        最終確認日時: {discord.utils.format_dt(result.checked_at)}（{discord.utils.format_dt(result.checked_at, "R")}）
         """
     else:
         embed.description = "Failed to validate settings. Please try again later."
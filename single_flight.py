@@ -0,0 +1,55 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+
+class SingleFlight:
+    """Runs at most one call per key; concurrent callers share its result.
+
+    A completed result accepted by `keep` is kept for `retention` seconds, so
+    repeats within that window get it back without running the call again.
+    Failed calls are never kept. The call runs in its own task, so a caller
+    that goes away doesn't cancel it for the others.
+    """
+
+    def __init__(self, retention: float = 30, max_size: int = 10000):
+        self.retention = retention
+        self.max_size = max_size
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self._results: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self.joined = 0
+        self.hits = 0
+
+    async def run(
+        self,
+        key: str,
+        func: Callable[[], Awaitable],
+        keep: Callable[[object], bool] = None,
+    ):
+        cached = self._results.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self.hits += 1
+                return cached[1]
+            del self._results[key]
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda task: self._finish(key, task, keep))
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task, keep: Callable[[object], bool]):
+        del self._in_flight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        if keep is not None and not keep(task.result()):
+            return
+        self._results[key] = (time.monotonic() + self.retention, task.result())
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_size:
+            self._results.popitem(last=False)
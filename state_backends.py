@@ -0,0 +1,336 @@
+import asyncio
+import json
+import os
+import time
+from logging import getLogger
+
+import aiosqlite
+
+from state_store import StateBackend, StateStore, VerificationState
+
+logger = getLogger("discord")
+
+# Fields update() may touch; they become JSON paths or hash fields below.
+FIELDS = frozenset(VerificationState.__slots__) - {"expires_at"}
+
+
+def _check_fields(fields: dict):
+    unknown = fields.keys() - FIELDS
+    if unknown:
+        raise KeyError(f"Unknown verification state fields: {', '.join(unknown)}")
+
+
+class SQLiteStateStore(StateBackend):
+    """States in a SQLite database in WAL mode, shared by every process on the host.
+
+    Each record is a JSON document. update() rewrites only the given fields
+    with json_set() in a single statement, so the Discord and Google callbacks
+    can't overwrite each other's sub-record. Expired rows are never returned
+    and are deleted by the sweeper. get() is a plain read and only writes to
+    push expires_at back once less than half of the TTL is left, so reads
+    don't queue behind the database's single writer.
+    """
+
+    event_poll_interval = 1
+
+    def __init__(self, path: str, ttl: float = 900):
+        super().__init__()
+        self.path = path
+        self.ttl = ttl
+        self._db: aiosqlite.Connection = None
+        self._open_lock = asyncio.Lock()
+        self._sweeper: asyncio.Task = None
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        # Live rows as of the last sweep; None until the first one.
+        self._live: int = None
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._db is not None:
+            return self._db
+        async with self._open_lock:
+            if self._db is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                db = await aiosqlite.connect(self.path, isolation_level=None)
+                await db.execute("PRAGMA journal_mode=WAL")
+                await db.execute("PRAGMA synchronous=NORMAL")
+                await db.execute("PRAGMA busy_timeout=5000")
+                await db.execute(
+                    "CREATE TABLE IF NOT EXISTS verification_state ("
+                    " state TEXT PRIMARY KEY,"
+                    " guild_id INTEGER,"
+                    " user_id INTEGER,"
+                    " data TEXT NOT NULL,"
+                    " expires_at REAL NOT NULL)"
+                )
+                await db.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_verification_state_user"
+                    " ON verification_state (guild_id, user_id)"
+                )
+                await db.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_verification_state_expires_at"
+                    " ON verification_state (expires_at)"
+                )
+                self._db = db
+        return self._db
+
+    async def _fetch_data(self, sql: str, parameters) -> VerificationState:
+        db = await self._connection()
+        async with db.execute(sql, parameters) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return VerificationState.from_dict(json.loads(row[0]))
+
+    async def create(self, state: str, record: VerificationState):
+        db = await self._connection()
+        await db.execute(
+            "INSERT OR REPLACE INTO verification_state"
+            " (state, guild_id, user_id, data, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (
+                state,
+                record.guild_id,
+                record.user_id,
+                json.dumps(record.to_dict()),
+                time.time() + self.ttl,
+            ),
+        )
+        return record
+
+    async def get(self, state: str):
+        now = time.time()
+        db = await self._connection()
+        async with db.execute(
+            "SELECT data, expires_at FROM verification_state"
+            " WHERE state = ? AND expires_at > ?",
+            (state, now),
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        data, expires_at = row
+        if expires_at - now < self.ttl / 2:
+            await db.execute(
+                "UPDATE verification_state SET expires_at = ?"
+                " WHERE state = ? AND expires_at > ?",
+                (now + self.ttl, state, now),
+            )
+        return VerificationState.from_dict(json.loads(data))
+
+    async def peek(self, state: str):
+        return await self._fetch_data(
+            "SELECT data FROM verification_state WHERE state = ? AND expires_at > ?",
+            (state, time.time()),
+        )
+
+    async def update(self, state: str, **fields):
+        _check_fields(fields)
+        if not fields:
+            return await self.get(state)
+        now = time.time()
+        paths = ", ".join("?, json(?)" for _ in fields)
+        parameters = []
+        for key, value in fields.items():
+            parameters += [f"$.{key}", json.dumps(value)]
+        record = await self._fetch_data(
+            f"UPDATE verification_state SET data = json_set(data, {paths}),"
+            " expires_at = ? WHERE state = ? AND expires_at > ? RETURNING data",
+            (*parameters, now + self.ttl, state, now),
+        )
+        self._notify(state)
+        return record
+
+    async def delete(self, state: str):
+        self._notify(state)
+        return await self._fetch_data(
+            "DELETE FROM verification_state WHERE state = ? RETURNING data", (state,)
+        )
+
+    async def find(self, guild_id: int, user_id: int):
+        db = await self._connection()
+        async with db.execute(
+            "SELECT state FROM verification_state"
+            " WHERE guild_id = ? AND user_id = ? AND expires_at > ?"
+            " ORDER BY rowid DESC LIMIT 1",
+            (guild_id, user_id, time.time()),
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        record = await self.get(row[0])
+        if record is None:
+            return None
+        return row[0], record
+
+    async def sweep(self):
+        db = await self._connection()
+        cursor = await db.execute(
+            "DELETE FROM verification_state WHERE expires_at <= ?", (time.time(),)
+        )
+        self.expirations += cursor.rowcount
+        await cursor.close()
+        async with db.execute("SELECT COUNT(*) FROM verification_state") as cursor:
+            (self._live,) = await cursor.fetchone()
+
+    def live_count(self):
+        return self._live
+
+    async def _sweep_forever(self, interval: float):
+        while True:
+            try:
+                await self.sweep()
+            except aiosqlite.Error as e:
+                logger.warning(f"Failed to sweep verification states: {e}")
+            await asyncio.sleep(interval)
+
+    def start_sweeper(self, interval: float = 60):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_forever(interval))
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    def stats(self):
+        return {
+            "backend": "sqlite",
+            "hits": self.hits,
+            "misses": self.misses,
+            "expirations": self.expirations,
+        }
+
+
+class RedisStateStore(StateBackend):
+    """States in Redis (or a Redis protocol compatible server), shared by every replica.
+
+    Each record is a hash with one JSON encoded field per attribute, so
+    update() is a single HSET of the changed fields and the Discord and Google
+    callbacks can't overwrite each other's sub-record. Keys carry a PEXPIRE
+    that every read and write pushes back, so Redis drops abandoned sessions.
+    """
+
+    event_poll_interval = 1
+
+    def __init__(self, url: str, ttl: float = 900, prefix: str = "enforcer:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError(
+                "STATE_BACKEND=redis needs the redis package: pip install redis"
+            )
+        super().__init__()
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, state: str) -> str:
+        return f"{self.prefix}state:{state}"
+
+    def _user_key(self, guild_id: int, user_id: int) -> str:
+        return f"{self.prefix}user:{guild_id}:{user_id}"
+
+    def _decode(self, data: dict) -> VerificationState:
+        if "guild_id" not in data:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return VerificationState.from_dict(
+            {key: json.loads(value) for key, value in data.items()}
+        )
+
+    async def create(self, state: str, record: VerificationState):
+        ttl = int(self.ttl * 1000)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._key(state))
+            pipe.hset(
+                self._key(state),
+                mapping={
+                    key: json.dumps(value) for key, value in record.to_dict().items()
+                },
+            )
+            pipe.pexpire(self._key(state), ttl)
+            if record.user_id is not None:
+                pipe.set(self._user_key(record.guild_id, record.user_id), state, px=ttl)
+            await pipe.execute()
+        return record
+
+    async def get(self, state: str):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hgetall(self._key(state))
+            pipe.pexpire(self._key(state), int(self.ttl * 1000))
+            data, _ = await pipe.execute()
+        return self._decode(data)
+
+    async def peek(self, state: str):
+        return self._decode(await self.redis.hgetall(self._key(state)))
+
+    async def update(self, state: str, **fields):
+        _check_fields(fields)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if fields:
+                pipe.hset(
+                    self._key(state),
+                    mapping={key: json.dumps(value) for key, value in fields.items()},
+                )
+            pipe.pexpire(self._key(state), int(self.ttl * 1000))
+            pipe.hgetall(self._key(state))
+            *_, data = await pipe.execute()
+        record = self._decode(data)
+        if record is None and data:
+            # The key expired before the HSET, which left a partial record behind.
+            await self.redis.delete(self._key(state))
+        self._notify(state)
+        return record
+
+    async def delete(self, state: str):
+        self._notify(state)
+        await self.redis.delete(self._key(state))
+
+    async def find(self, guild_id: int, user_id: int):
+        user_key = self._user_key(guild_id, user_id)
+        state = await self.redis.get(user_key)
+        if state is None:
+            return None
+        record = await self.get(state)
+        if record is None:
+            return None
+        await self.redis.pexpire(user_key, int(self.ttl * 1000))
+        return state, record
+
+    async def close(self):
+        await self.redis.aclose()
+
+    def stats(self):
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
+
+
+def create_state_store(backend: str = None) -> StateBackend:
+    """Build the store selected by STATE_BACKEND: "memory", "sqlite" or "redis"."""
+    backend = backend or os.getenv("STATE_BACKEND", "memory")
+    ttl = float(os.getenv("STATE_TTL", "900"))
+    if backend == "memory":
+        return StateStore(max_size=int(os.getenv("STATE_MAX_SIZE", "10000")), ttl=ttl)
+    if backend == "sqlite":
+        return SQLiteStateStore(
+            os.getenv("STATE_SQLITE_PATH", "instance/states.db"), ttl=ttl
+        )
+    if backend == "redis":
+        return RedisStateStore(
+            os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0"), ttl=ttl
+        )
+    raise ValueError(f"Unknown STATE_BACKEND: {backend}")
@@ -0,0 +1,256 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class VerificationState:
+    __slots__ = (
+        "guild_name",
+        "domain",
+        "guild_id",
+        "user_id",
+        "discord",
+        "google",
+        "status",
+        "timings",
+        "expires_at",
+    )
+
+    def __init__(
+        self, guild_name: str, domain: list[str], guild_id: int, user_id: int = None
+    ):
+        self.guild_name = guild_name
+        self.domain = domain
+        self.guild_id = guild_id
+        # The Discord user who pressed the button, used to find their live state.
+        self.user_id = user_id
+        self.discord = None
+        self.google = None
+        # None while linking accounts, then "verified" -> "granted" or "failed".
+        self.status = None
+        # Stage name -> milliseconds, recorded in the audit log at the end.
+        self.timings = {}
+        self.expires_at = 0.0
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        record = cls(
+            data["guild_name"], data["domain"], data["guild_id"], data.get("user_id")
+        )
+        record.discord = data.get("discord")
+        record.google = data.get("google")
+        record.status = data.get("status")
+        record.timings = data.get("timings") or {}
+        return record
+
+    def to_dict(self):
+        return {
+            "guild_name": self.guild_name,
+            "domain": self.domain,
+            "guild_id": self.guild_id,
+            "user_id": self.user_id,
+            "discord": self.discord,
+            "google": self.google,
+            "status": self.status,
+            "timings": self.timings,
+        }
+
+
+class StateBackend:
+    """Interface of the verification state stores, keyed by the OAuth `state` parameter.
+
+    `subscribe` only hears about changes made through this instance; stores
+    shared between processes set a short `event_poll_interval` so subscribers
+    re-read the state soon enough to notice changes made elsewhere.
+    """
+
+    # How often subscribers re-read the state when no change was announced.
+    event_poll_interval = 15
+    ttl: float
+
+    def __init__(self):
+        self._subscribers: dict[str, set[asyncio.Event]] = {}
+
+    async def create(self, state: str, record: VerificationState):
+        raise NotImplementedError
+
+    async def get(self, state: str):
+        """Return the record and refresh its TTL, or None if missing or expired."""
+        raise NotImplementedError
+
+    async def peek(self, state: str):
+        """Like get(), but leaves the TTL alone. For polling that isn't user activity."""
+        raise NotImplementedError
+
+    async def update(self, state: str, **fields):
+        """Replace the given top-level fields of a live record and return it."""
+        raise NotImplementedError
+
+    async def delete(self, state: str):
+        raise NotImplementedError
+
+    async def find(self, guild_id: int, user_id: int):
+        """Return (state, record) of the user's latest live state, or None."""
+        raise NotImplementedError
+
+    def subscribe(self, state: str) -> asyncio.Event:
+        """Return an event that is set whenever `state` is updated or deleted."""
+        event = asyncio.Event()
+        self._subscribers.setdefault(state, set()).add(event)
+        return event
+
+    def unsubscribe(self, state: str, event: asyncio.Event):
+        subscribers = self._subscribers.get(state)
+        if subscribers is not None:
+            subscribers.discard(event)
+            if not subscribers:
+                del self._subscribers[state]
+
+    def _notify(self, state: str):
+        for event in self._subscribers.get(state, ()):
+            event.set()
+
+    def live_count(self):
+        """Number of live states, or None where this store can't count them cheaply."""
+        return None
+
+    def start_sweeper(self, interval: float = 60):
+        pass
+
+    def stop_sweeper(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class StateStore(StateBackend):
+    """Verification states kept in this process's memory.
+
+    Entries expire `ttl` seconds after they were last touched, and the least
+    recently used entry is evicted once `max_size` is reached. States created
+    for a user are also indexed by (guild_id, user_id), see `find`.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 900):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self._states: OrderedDict[str, VerificationState] = OrderedDict()
+        # (guild_id, user_id) -> the user's latest state.
+        self._by_user: dict[tuple[int, int], str] = {}
+        self._sweeper: asyncio.Task = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._states)
+
+    def live_count(self):
+        return len(self)
+
+    def _touch(self, state: str, record: VerificationState):
+        record.expires_at = time.monotonic() + self.ttl
+        self._states.move_to_end(state)
+
+    def _forget(self, state: str, record: VerificationState):
+        key = (record.guild_id, record.user_id)
+        if self._by_user.get(key) == state:
+            del self._by_user[key]
+
+    async def create(self, state: str, record: VerificationState):
+        if state not in self._states:
+            while len(self._states) >= self.max_size:
+                self._forget(*self._states.popitem(last=False))
+                self.evictions += 1
+        self._states[state] = record
+        if record.user_id is not None:
+            self._by_user[(record.guild_id, record.user_id)] = state
+        self._touch(state, record)
+        return record
+
+    async def find(self, guild_id: int, user_id: int):
+        state = self._by_user.get((guild_id, user_id))
+        if state is None:
+            return None
+        record = await self.get(state)
+        if record is None:
+            return None
+        return state, record
+
+    async def peek(self, state: str):
+        record = self._states.get(state)
+        if record is None:
+            self.misses += 1
+            return None
+        if record.expires_at <= time.monotonic():
+            del self._states[state]
+            self._forget(state, record)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return record
+
+    async def get(self, state: str):
+        record = await self.peek(state)
+        if record is not None:
+            self._touch(state, record)
+        return record
+
+    async def update(self, state: str, **fields):
+        record = await self.get(state)
+        if record is None:
+            return None
+        for key, value in fields.items():
+            setattr(record, key, value)
+        self._notify(state)
+        return record
+
+    async def delete(self, state: str):
+        self._notify(state)
+        record = self._states.pop(state, None)
+        if record is not None:
+            self._forget(state, record)
+        return record
+
+    def sweep(self):
+        now = time.monotonic()
+        # Entries are ordered by last access, so expired ones are at the front.
+        while self._states:
+            state, record = next(iter(self._states.items()))
+            if record.expires_at > now:
+                break
+            del self._states[state]
+            self._forget(state, record)
+            self.expirations += 1
+
+    async def _sweep_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def start_sweeper(self, interval: float = 60):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_forever(interval))
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    def stats(self):
+        return {
+            "size": len(self._states),
+            "users": len(self._by_user),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
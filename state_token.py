@@ -0,0 +1,85 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from logging import getLogger
+
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = getLogger("discord")
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class StateTokenSigner:
+    """Issues `state` values that are bound to the guild and user who started verification.
+
+    A token is `base64(guild_id.user_id.expires_at.nonce).base64(hmac)`, so a
+    forged or expired state is rejected without touching the state store.
+    """
+
+    def __init__(self, secret: bytes, max_age: int = 3600):
+        self.secret = secret
+        self.max_age = max_age
+
+    def _sign(self, payload: str) -> str:
+        digest = hmac.new(self.secret, payload.encode(), hashlib.sha256).digest()
+        return _b64encode(digest[:16])
+
+    def issue(self, guild_id: int, user_id: int) -> str:
+        expires_at = int(time.time()) + self.max_age
+        payload = _b64encode(
+            f"{guild_id}.{user_id}.{expires_at}.{secrets.token_hex(8)}".encode()
+        )
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token: str):
+        """Return (guild_id, user_id, expires_at), or None if the token is invalid or expired."""
+        if not token.isascii():
+            # compare_digest() raises TypeError on non-ASCII strings.
+            return None
+        payload, _, signature = token.partition(".")
+        if not signature or not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            guild_id, user_id, expires_at, _ = _b64decode(payload).decode().split(".")
+        except ValueError:
+            return None
+        if int(expires_at) < time.time():
+            return None
+        return int(guild_id), int(user_id), int(expires_at)
+
+
+def _load_secret() -> bytes:
+    secret = os.getenv("STATE_SECRET")
+    if secret:
+        return secret.encode()
+    # Tokens issued by one process are checked by another, so a per-process
+    # random secret would reject every callback.
+    if (
+        os.getenv("RUN_MODE", "all") != "all"
+        or os.getenv("STATE_BACKEND", "memory") != "memory"
+    ):
+        raise RuntimeError(
+            "STATE_SECRET must be set when the bot and web server run as separate "
+            "processes or the state store is shared."
+        )
+    logger.warning(
+        "STATE_SECRET is not set. Using a random secret, so verification URLs "
+        "only work with this process and stop working after a restart."
+    )
+    return secrets.token_bytes(32)
+
+
+state_tokens = StateTokenSigner(
+    _load_secret(), max_age=int(os.getenv("STATE_TOKEN_MAX_AGE", "3600"))
+)
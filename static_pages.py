@@ -0,0 +1,95 @@
+import gzip
+import hashlib
+import os
+
+import brotli
+from fastapi import Request, Response
+
+
+class StaticPage:
+    __slots__ = ("variants",)
+
+    def __init__(self, body: bytes):
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        # encoding -> (strong ETag, body). Each encoding is a different representation.
+        self.variants = {
+            "br": (f'"{digest}-br"', brotli.compress(body, quality=11)),
+            "gzip": (f'"{digest}-gz"', gzip.compress(body, compresslevel=9)),
+            "identity": (f'"{digest}"', body),
+        }
+
+
+def _quality(params: str) -> float:
+    params = params.strip()
+    if not params.startswith("q="):
+        return 1.0
+    try:
+        return float(params[2:] or 0)
+    except ValueError:
+        # A malformed q-value is ignored rather than failing the request.
+        return 1.0
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        if _quality(params) == 0:
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+class StaticPages:
+    """HTML templates read once and kept in memory, precompressed."""
+
+    def __init__(self, cache_control: str = "public, max-age=300"):
+        self.cache_control = cache_control
+        self.pages: dict[str, StaticPage] = {}
+
+    def load(self, name: str, path: str):
+        with open(path, "rb") as f:
+            self.pages[name] = StaticPage(f.read())
+
+    def response(
+        self,
+        request: Request,
+        name: str,
+        status_code: int = 200,
+        headers: dict = None,
+    ) -> Response:
+        page = self.pages[name]
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = next(
+            (e for e in ("br", "gzip") if e in accepted or "*" in accepted),
+            "identity",
+        )
+        etag, body = page.variants[encoding]
+        response_headers = {
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+            # Error pages share their body with every status code, never cache them.
+            "Cache-Control": self.cache_control if status_code == 200 else "no-store",
+            **(headers or {}),
+        }
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+
+        if status_code == 200:
+            if_none_match = request.headers.get("if-none-match", "")
+            candidates = {
+                tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+            }
+            if etag in candidates or "*" in candidates:
+                response_headers.pop("Content-Encoding", None)
+                return Response(status_code=304, headers=response_headers)
+
+        return Response(
+            body,
+            status_code=status_code,
+            media_type="text/html; charset=utf-8",
+            headers=response_headers,
+        )
+
+
+static_pages = StaticPages(os.getenv("PAGE_CACHE_CONTROL", "public, max-age=300"))
@@ -0,0 +1,118 @@
+import asyncio
+from collections import defaultdict
+from logging import getLogger
+
+import discord
+
+from metrics import failure
+
+logger = getLogger("discord")
+
+MESSAGE_LIMIT = 2000
+
+
+class VerificationLog:
+    """Posts "verification completed" messages to the guild's log channel.
+
+    In `single` mode every verification gets its own message, as before.
+    In `digest` mode mentions are buffered per channel and posted together
+    every `interval` seconds, or as soon as `batch_size` of them are waiting.
+    """
+
+    def __init__(
+        self,
+        bot: discord.Client,
+        mode: str = "single",
+        interval: float = 10,
+        batch_size: int = 50,
+    ):
+        self.bot = bot
+        self.mode = mode
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending: defaultdict[int, list[str]] = defaultdict(list)
+        self._locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._flusher: asyncio.Task = None
+
+    async def log(self, channel_id: int, mention: str):
+        if self.mode != "digest":
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                return
+            async with self._locks[channel_id]:
+                try:
+                    await channel.send(f"{mention}さんの認証が完了しました！")
+                except (discord.HTTPException, asyncio.TimeoutError, OSError) as e:
+                    # The role was already granted; only the log message is lost.
+                    failure("verification_log", type(e).__name__)
+                    logger.warning(
+                        f"Failed to send verification log to {channel_id}: {e}"
+                    )
+            return
+        pending = self._pending[channel_id]
+        pending.append(mention)
+        if len(pending) >= self.batch_size:
+            await self.flush(channel_id)
+
+    def start(self):
+        if self.mode == "digest" and (self._flusher is None or self._flusher.done()):
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush_all()
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush_all()
+
+    async def flush_all(self):
+        for channel_id in list(self._pending):
+            await self.flush(channel_id)
+
+    async def flush(self, channel_id: int):
+        async with self._locks[channel_id]:
+            mentions = self._pending.pop(channel_id, [])
+            if not mentions:
+                return
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                return
+            for index, content in enumerate(self.build_messages(mentions)):
+                try:
+                    await channel.send(
+                        content, allowed_mentions=discord.AllowedMentions.none()
+                    )
+                except (discord.HTTPException, asyncio.TimeoutError, OSError) as e:
+                    failure("verification_log", type(e).__name__)
+                    logger.warning(f"Failed to send verification log digest: {e}")
+                    if not isinstance(e, discord.Forbidden):
+                        self._pending[channel_id][:0] = mentions
+                    return
+                del mentions[: content.count("\n")]
+
+    def build_messages(self, mentions: list[str]) -> list[str]:
+        """Split mentions into messages of at most batch_size mentions and MESSAGE_LIMIT characters."""
+        messages = []
+        lines = []
+        length = 0
+        for mention in mentions:
+            if lines and (
+                len(lines) >= self.batch_size
+                or length + len(mention) + 1 > MESSAGE_LIMIT - 64
+            ):
+                messages.append(self._format(lines))
+                lines = []
+                length = 0
+            lines.append(mention)
+            length += len(mention) + 1
+        if lines:
+            messages.append(self._format(lines))
+        return messages
+
+    @staticmethod
+    def _format(lines: list[str]) -> str:
+        return f"以下の{len(lines)}人の認証が完了しました！\n" + "\n".join(lines)